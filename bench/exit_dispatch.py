@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+#
+# Exit dispatch microbenchmark: compares the old per-exit subclass lookup
+# with the import-time dispatch table and with preallocated exit views.
+
+import sys
+import time
+
+from guest import create_guest, OUT_LOOP
+import pykvm
+from pykvm.exitreason import KvmExit
+
+N = 200000
+
+def legacy_from_vcpu(vcpu, dt):
+    # KvmExit.from_vcpu() as it was before the dispatch table: the subclass
+    # map is rebuilt on every exit.
+    subclasses = dict((c.code, c) for c in KvmExit.__subclasses__())
+    r = subclasses[vcpu.kvm_run.exit_reason](vcpu)
+    r.dt = dt
+    return r
+
+def bench_dispatch(label, vcpu, fn):
+    t0 = time.time()
+    for i in xrange(N):
+        x = fn(vcpu, 0.0)
+        x.port
+    dt = time.time() - t0
+    print '{:<24} {:>12.0f} exits/sec (dispatch only)'.format(label, N / dt)
+
+def bench_run(label, vcpu):
+    t0 = time.time()
+    for i in xrange(N):
+        x = vcpu.run()
+        x.port
+    dt = time.time() - t0
+    print '{:<24} {:>12.0f} exits/sec (KVM_RUN)'.format(label, N / dt)
+
+def main():
+    kvm = pykvm.Kvm()
+    vm, vcpu = create_guest(kvm, OUT_LOOP)
+
+    # Take one real exit so kvm_run holds a KVM_EXIT_IO.
+    vcpu.run()
+
+    views = KvmExit.views_for(vcpu)
+    bench_dispatch('before: from_vcpu', vcpu, legacy_from_vcpu)
+    bench_dispatch('after: from_vcpu', vcpu, KvmExit.from_vcpu)
+    bench_dispatch('exit views', vcpu,
+            lambda v, dt: views[v.kvm_run.exit_reason])
+
+    bench_run('run() snapshots', vcpu)
+    vcpu.use_exit_views()
+    bench_run('run() exit views', vcpu)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
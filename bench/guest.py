@@ -0,0 +1,105 @@
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+#
+# Helpers for the benchmarks: tiny real-mode guests built from raw bytes.
+
+import os, os.path
+import sys
+import mmap
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+RAM_SIZE = 1 << 20
+CODE_ADDR = 0x1000
+
+# Benchmark guests, in the spirit of misc/entry_code16.s. MMIO guests
+# expect RAM to end below 0xE0000.
+
+# mov dx, 0x42
+# l: out dx, al
+#    jmp l
+OUT_LOOP = '\xBA\x42\x00' '\xEE' '\xEB\xFD'
+
+# mov dx, 0x42
+# l: in al, dx
+#    jmp l
+IN_LOOP = '\xBA\x42\x00' '\xEC' '\xEB\xFD'
+
+# mov ax, 0xE000
+# mov ds, ax
+# l: mov [0], al
+#    jmp l
+MMIO_WRITE_LOOP = '\xB8\x00\xE0' '\x8E\xD8' '\xA2\x00\x00' '\xEB\xFB'
+
+# mov ax, 0xE000
+# mov ds, ax
+# l: mov al, [0]
+#    jmp l
+MMIO_READ_LOOP = '\xB8\x00\xE0' '\x8E\xD8' '\xA0\x00\x00' '\xEB\xFB'
+
+# Dword accesses at linear 0xDFFFF, which KVM splits at the page boundary
+# into a 1-byte and a 3-byte MMIO exit.
+#
+# mov ax, 0xDF00
+# mov ds, ax
+# l: mov [0xFFF], eax
+#    jmp l
+MMIO_SPLIT_WRITE_LOOP = '\xB8\x00\xDF' '\x8E\xD8' '\x66\xA3\xFF\x0F' '\xEB\xFA'
+
+# mov ax, 0xDF00
+# mov ds, ax
+# l: mov eax, [0xFFF]
+#    jmp l
+MMIO_SPLIT_READ_LOOP = '\xB8\x00\xDF' '\x8E\xD8' '\x66\xA1\xFF\x0F' '\xEB\xFA'
+
+# l: hlt
+#    jmp l
+HLT_LOOP = '\xF4' '\xEB\xFD'
+
+# l: mov si, 0x2000
+#    mov cx, 64
+#    mov dx, 0x42
+#    rep outsb
+#    jmp l
+REP_OUTSB_LOOP = '\xBE\x00\x20' '\xB9\x40\x00' '\xBA\x42\x00' '\xF3\x6E' '\xEB\xF3'
+
+# l: mov ax, 0x1000
+#    mov cx, 128
+# t: mov ds, ax
+#    inc byte [0]
+#    add ax, 0x100       (next 4K page)
+#    loop t
+#    out 0x42, al
+#    jmp l
+MEM_TOUCH_LOOP = '\xB8\x00\x10' '\xB9\x80\x00' '\x8E\xD8' '\xFE\x06\x00\x00' \
+                 '\x05\x00\x01' '\xE2\xF5' '\xE6\x42' '\xEB\xEB'
+
+def create_guest(kvm, code, ram_size=RAM_SIZE, name='bench', nr_vcpus=1):
+    """Create a VM whose vcpus all execute code in real mode at CODE_ADDR.
+
+    Returns (vm, first vcpu); the others are in vm.vcpus.
+    """
+    vm = kvm.create_vm(name)
+    for i in xrange(nr_vcpus):
+        vm.add_vcpu(i)
+
+    m = mmap.mmap(-1, ram_size)
+    m[CODE_ADDR:CODE_ADDR+len(code)] = code
+    vm.add_mem_region(0, m)
+
+    for vcpu in vm.vcpus.itervalues():
+        reset_vcpu(vcpu)
+    return vm, vm.vcpus[0]
+
+def reset_vcpu(vcpu):
+    sregs = vcpu.get_sregs()
+    for seg in (sregs.cs, sregs.ds, sregs.es, sregs.fs, sregs.gs, sregs.ss):
+        seg.base = 0
+        seg.selector = 0
+    vcpu.set_sregs(sregs)
+
+    regs = vcpu.get_regs()
+    regs.rip = CODE_ADDR
+    regs.rflags = 0x2
+    vcpu.set_regs(regs)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+#
+# Userspace overhead benchmark. Runs a vcpu on the scripted LoopbackBackend,
+# so KVM_RUN costs next to nothing and what is measured is pykvm itself:
+# exit construction, bus dispatch, stats and tracing. Works without /dev/kvm.
+#
+# usage: loopback.py [-n EXITS] [--profile CONFIG]
+
+import os, os.path
+import sys
+import mmap
+import time
+import argparse
+import cProfile
+import pstats
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pykvm
+from pykvm.backend import io_out, mmio_write, hlt
+from pykvm.trace import TraceRecorder
+
+PORT = 0x10
+MMIO_ADDR = 0xD0000000
+BATCH = 1000        # exits per run() call; the last one is unhandled
+
+class NullDevice(pykvm.Device):
+    def io_write(self, port, size, value):
+        pass
+
+    def mmio_write(self, addr, size, value):
+        pass
+
+def make_vcpu(script):
+    kvm = pykvm.Kvm(pykvm.LoopbackBackend(script, repeat=True))
+    vm = kvm.create_vm('loopback')
+    vm.add_mem_region(0, mmap.mmap(-1, 0x10000))
+    vcpu = vm.add_vcpu(0)
+    dev = NullDevice()
+    vm.io_bus.register(PORT, 1, dev)
+    vm.mmio_bus.register(MMIO_ADDR, 0x1000, dev)
+    return vcpu
+
+def io_script():
+    return [io_out(PORT, 1, 0)] * (BATCH - 1) + [hlt()]
+
+def mmio_script():
+    return [mmio_write(MMIO_ADDR, 4, 0)] * (BATCH - 1) + [hlt()]
+
+def setup_views(vcpu):
+    vcpu.use_exit_views()
+
+def setup_notiming(vcpu):
+    vcpu.timing = False
+
+def setup_stats(vcpu):
+    vcpu.enable_stats()
+
+def setup_trace(vcpu):
+    vcpu.set_trace(TraceRecorder())
+
+CONFIGS = (
+    # name, script, setup
+    ('io',              io_script,      None),
+    ('io+notiming',     io_script,      setup_notiming),
+    ('io+views',        io_script,      setup_views),
+    ('io+stats',        io_script,      setup_stats),
+    ('io+trace',        io_script,      setup_trace),
+    ('mmio',            mmio_script,    None),
+    ('mmio+views',      mmio_script,    setup_views),
+)
+
+def run_config(script, setup, n):
+    vcpu = make_vcpu(script())
+    if setup:
+        setup(vcpu)
+    t0 = time.time()
+    for i in xrange(n // BATCH):
+        vcpu.run()
+    dt = time.time() - t0
+    return dt, (n // BATCH) * BATCH
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--exits', type=int, default=200000)
+    ap.add_argument('--profile', metavar='CONFIG',
+            help='run one configuration under cProfile')
+    args = ap.parse_args()
+
+    configs = dict((name, (script, setup)) for name, script, setup in CONFIGS)
+    if args.profile:
+        script, setup = configs[args.profile]
+        prof = cProfile.Profile()
+        prof.runcall(run_config, script, setup, args.exits)
+        pstats.Stats(prof).sort_stats('cumulative').print_stats(25)
+        return 0
+
+    print '{:<16} {:>12} {:>10}'.format('config', 'exits/sec', 'us/exit')
+    for name, script, setup in CONFIGS:
+        dt, n = run_config(script, setup, args.exits)
+        print '{:<16} {:>12.0f} {:>10.2f}'.format(name, n / dt, dt * 1e6 / n)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
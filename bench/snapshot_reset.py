@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+#
+# Snapshot-reset benchmark: a guest dirties a few pages and halts, then the
+# VM is reset to its checkpoint. Compares Vm.restore() (dirty pages only)
+# with copying back all of guest RAM, for growing amounts of RAM.
+#
+# usage: snapshot_reset.py [seconds]
+
+import sys
+import time
+import mmap
+
+from guest import create_guest
+import pykvm
+
+TOUCH_PAGES = 16
+
+#    mov cx, TOUCH_PAGES
+#    mov ax, 0x2000
+# l: mov ds, ax
+#    mov [0], al
+#    add ax, 0x100       (next 4K page)
+#    loop l
+#    hlt
+TOUCH_CODE = '\xB9' + chr(TOUCH_PAGES) + '\x00' '\xB8\x00\x20' \
+             '\x8E\xD8' '\xA2\x00\x00' '\x05\x00\x01' '\xE2\xF6' '\xF4'
+
+def bench(kvm, extra_mb, full, seconds):
+    vm, vcpu = create_guest(kvm, TOUCH_CODE)
+    if extra_mb:
+        # High RAM the guest never touches; it only grows the reset cost
+        # of a full copy.
+        vm.add_mem_region(0x10000000, mmap.mmap(-1, extra_mb << 20))
+    cp = vm.checkpoint()
+
+    n = 0
+    t0 = time.time()
+    deadline = t0 + seconds
+    while time.time() < deadline:
+        exit = vcpu.run()
+        assert isinstance(exit, pykvm.KvmExitHlt), exit
+        if full:
+            cp.restore_memory(vm, incremental=False)
+            cp.restore_vcpus(vm)
+        else:
+            vm.restore()
+        n += 1
+    return n / (time.time() - t0)
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    kvm = pykvm.Kvm()
+
+    print '{:>10} {:>20} {:>20}'.format('RAM (MB)', 'restore() resets/s', 'full copy resets/s')
+    for extra_mb in (0, 16, 64, 256):
+        inc = bench(kvm, extra_mb, False, seconds)
+        full = bench(kvm, extra_mb, True, seconds)
+        print '{:>10} {:>20.0f} {:>20.0f}'.format(1 + extra_mb, inc, full)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+#
+# Exit round-trip benchmark suite. Each workload is a tiny guest that exits
+# in a loop; every exit goes back to Python through Vcpu.run(). Reports
+# exits/sec and p50/p99 round-trip latency per workload, plus VM and vcpu
+# creation time, and can save or compare JSON results.
+#
+# usage: suite.py [-s SECONDS] [--json OUT] [--compare BASELINE [--tolerance F]]
+
+import sys
+import time
+import json
+import argparse
+import platform
+from array import array
+
+from guest import *
+import pykvm
+from pykvm.stats import now_ns
+
+# MMIO device for the split workloads: it takes the 3-byte fragment of each
+# page-crossing access, and the 1-byte one is returned from run().
+SPLIT_DEVICE = (0xE0000, 0x1000)
+
+WORKLOADS = (
+    # name, guest code, RAM size, MMIO device range
+    ('port_out',    OUT_LOOP,           RAM_SIZE,   None),
+    ('port_in',     IN_LOOP,            RAM_SIZE,   None),
+    ('mmio_write',  MMIO_WRITE_LOOP,    0x80000,    None),
+    ('mmio_read',   MMIO_READ_LOOP,     0x80000,    None),
+    ('mmio_split_write', MMIO_SPLIT_WRITE_LOOP, 0x80000, SPLIT_DEVICE),
+    ('mmio_split_read',  MMIO_SPLIT_READ_LOOP,  0x80000, SPLIT_DEVICE),
+    ('hlt',         HLT_LOOP,           RAM_SIZE,   None),
+    ('rep_outsb',   REP_OUTSB_LOOP,     RAM_SIZE,   None),
+    ('mem_touch',   MEM_TOUCH_LOOP,     RAM_SIZE,   None),
+)
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+def run_workload(kvm, code, ram_size, device, seconds, views):
+    vm, vcpu = create_guest(kvm, code, ram_size)
+    try:
+        if device is not None:
+            vm.mmio_bus.register(device[0], device[1], pykvm.Device())
+        vcpu.timing = False
+        if views:
+            vcpu.use_exit_views()
+
+        lat = array('d')
+        end = time.time() + seconds
+        while time.time() < end:
+            for i in xrange(1000):
+                t0 = now_ns()
+                vcpu.run()
+                lat.append(now_ns() - t0)
+    finally:
+        vm.close()
+
+    total = sum(lat)
+    lat = sorted(lat)
+    return {
+        'exits':            len(lat),
+        'exits_per_sec':    len(lat) / (total * 1e-9),
+        'p50_us':           percentile(lat, 0.50) / 1000.0,
+        'p99_us':           percentile(lat, 0.99) / 1000.0,
+    }
+
+def bench_create(kvm, n=20):
+    vm_ns = vcpu_ns = 0
+    for i in xrange(n):
+        t0 = now_ns()
+        vm = kvm.create_vm('create')
+        try:
+            t1 = now_ns()
+            vm.add_vcpu(0)
+            t2 = now_ns()
+        finally:
+            vm.close()
+        vm_ns += t1 - t0
+        vcpu_ns += t2 - t1
+    return {
+        'vm_ms':    vm_ns / n / 1e6,
+        'vcpu_ms':  vcpu_ns / n / 1e6,
+    }
+
+def compare(results, baseline, tolerance):
+    # Returns the list of workloads whose exit rate regressed.
+    bad = []
+    for name, r in sorted(results['workloads'].iteritems()):
+        b = baseline['workloads'].get(name)
+        if b is None:
+            continue
+        change = r['exits_per_sec'] / b['exits_per_sec'] - 1
+        print '{:<24} {:>+8.1%}'.format(name, change)
+        if change < -tolerance:
+            bad.append(name)
+    return bad
+
+def main():
+    ap = argparse.ArgumentParser(description='pykvm exit round-trip benchmarks')
+    ap.add_argument('-s', '--seconds', type=float, default=1.0,
+            help='time per workload')
+    ap.add_argument('--json', help='write results to this file')
+    ap.add_argument('--compare', help='baseline JSON results to compare with')
+    ap.add_argument('--tolerance', type=float, default=0.10,
+            help='allowed exits/sec drop before failing (default 0.10)')
+    args = ap.parse_args()
+
+    kvm = pykvm.Kvm()
+    results = {
+        'meta': {
+            'time':     time.time(),
+            'python':   platform.python_version(),
+            'kernel':   platform.release(),
+        },
+        'create':       bench_create(kvm),
+        'workloads':    {},
+    }
+
+    print 'VM create: {vm_ms:.3f} ms   vcpu create: {vcpu_ms:.3f} ms'.format(**results['create'])
+    print '{:<24} {:>12} {:>10} {:>10}'.format('workload', 'exits/sec', 'p50 us', 'p99 us')
+    for name, code, ram_size, device in WORKLOADS:
+        for views in (False, True):
+            key = name + ('+views' if views else '')
+            r = run_workload(kvm, code, ram_size, device, args.seconds, views)
+            results['workloads'][key] = r
+            print '{:<24} {exits_per_sec:>12.0f} {p50_us:>10.1f} {p99_us:>10.1f}'.format(key, **r)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print '\nChange vs. {}:'.format(args.compare)
+        bad = compare(results, baseline, args.tolerance)
+        if bad:
+            print 'Regressed: ' + ', '.join(bad)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+#
+# Vcpu scaling benchmark: runs 1..N vcpus with Vm.run_all() and reports
+# aggregate exit and guest-work throughput.
+#
+# usage: vcpu_scaling.py [max_vcpus] [seconds]
+
+import sys
+import time
+import multiprocessing
+
+from guest import create_guest, OUT_LOOP
+import pykvm
+
+SPIN = 100000
+
+# l: mov ecx, SPIN
+#    loop $            (spin in the guest)
+#    out 0x42, al
+#    jmp l
+SPIN_LOOP = '\x66\xB9' + chr(SPIN & 0xFF) + chr((SPIN >> 8) & 0xFF) + \
+            chr((SPIN >> 16) & 0xFF) + '\x00' + \
+            '\x67\xE2\xFD' '\xE6\x42' '\xEB\xF3'
+
+def bench(kvm, code, nr_vcpus, seconds):
+    vm, _ = create_guest(kvm, code, nr_vcpus=nr_vcpus)
+    counts = dict((cpuid, 0) for cpuid in vm.vcpus)
+    deadline = [None]
+
+    def handler(vcpu, exit):
+        counts[vcpu.cpuid] += 1
+        return time.time() < deadline[0]
+
+    t0 = time.time()
+    deadline[0] = t0 + seconds
+    vm.run_all(handler)
+    dt = time.time() - t0
+    return sum(counts.itervalues()) / dt
+
+def main():
+    max_vcpus = int(sys.argv[1]) if len(sys.argv) > 1 else multiprocessing.cpu_count()
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    kvm = pykvm.Kvm()
+
+    print '{:>6} {:>16} {:>20}'.format('vcpus', 'I/O exits/sec', 'guest loops/sec')
+    for n in xrange(1, max_vcpus + 1):
+        io = bench(kvm, OUT_LOOP, n, seconds)
+        spin = bench(kvm, SPIN_LOOP, n, seconds) * SPIN
+        print '{:>6} {:>16.0f} {:>20.0f}'.format(n, io, spin)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
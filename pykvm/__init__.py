@@ -3,19 +3,28 @@
 # (C) 2015 Jonathon Reinhart
 
 import os
+import sys
+import errno
 import struct
-from fcntl import fcntl, ioctl
+import threading
+import tempfile
+from bisect import bisect_right
+from heapq import heappush, heappop
 import mmap
 import ctypes
-import time 
 
 from kvmstructs import *
 from exitreason import *
+from errors import KvmError
+from bus import Device, IoBus, MmioBus
+from bitmap import iter_set_bits
+from stats import ExitStats, VmStats, now_ns
+from backend import KernelBackend, LoopbackBackend
+from eventfd import EventFd
+from memory import alloc_guest_ram, map_file
 
-__all__ = ['Kvm', 'KvmError']
-
-class KvmError(Exception):
-    pass
+__all__ = ['Kvm', 'KvmError', 'Device', 'IoBus', 'MmioBus',
+        'KernelBackend', 'LoopbackBackend']
 
 
 class Vcpu(object):
@@ -23,6 +32,45 @@ class Vcpu(object):
         self.vm = vm
         self.fd = fd
         self.cpuid = cpuid
+        self._ioctl = vm.kvm.backend.ioctl
+        self._exit_views = None
+        self._sync_regs = 0
+
+        # Register cache: (struct, bytes as fetched from KVM or None).
+        self._reg_cache = False
+        self._cached_regs = None
+        self._cached_sregs = None
+
+        # Software TLB: guest virtual page -> guest physical page, valid for
+        # the CR0/CR3/CR4 values last seen by get_sregs()/set_sregs().
+        # translate() rechecks those once after each exit.
+        self._tlb = {}
+        self._tlb_crs = None
+        self._exits = 0
+        self._tlb_exits = 0
+
+        # kvm_msrs buffer reused by get_msrs()/set_msrs(); grown on demand.
+        self._msrs = kvm_msrs(0)()
+
+        # Exit timing; with timing off, run() makes no clock calls at all
+        # and exits have dt = None. Both flags start out as the VM's.
+        self.timing = vm.timing
+        self.stats = ExitStats(vm.mmio_bus)
+        self._record_stats = vm._record_stats
+        self._trace = None
+        self._trace_rip = False
+
+        # Input record/replay (pykvm.replay)
+        self._input_recorder = None
+        self._pending_input = None
+        self._input_replayer = None
+
+        self._guest_debug = kvm_guest_debug()
+
+        # Userspace interrupt queue: a heap of (-priority, seq, vector).
+        self._irq_queue = []
+        self._irq_seq = 0
+        self._irq_lock = threading.Lock()
 
         self._map_vcpu_area()
 
@@ -31,24 +79,321 @@ class Vcpu(object):
         return '<Vcpu: vm={} fd={} cpuid={}>'.format(
                 self.vm.name, self.fd, self.cpuid)
 
+    def close(self):
+        """Unmap kvm_run and close the vcpu fd. See Vm.close()."""
+        if self.fd is None:
+            return
+        self._exit_views = None
+        self.kvm_run = self._sync = self.coalesced_mmio_ring = None
+        self.mmap.close()
+        self.vm.kvm.backend.close(self.fd)
+        self.fd = None
+
     def _map_vcpu_area(self):
-        # http://stackoverflow.com/a/3640617
         sz = self.vm.kvm._get_vcpu_mmap_size()
-        self.mmap = mmap.mmap(self.fd, sz, mmap.MAP_SHARED, (mmap.PROT_READ|mmap.PROT_WRITE))
+        self.mmap = self.vm.kvm.backend.mmap_vcpu(self.fd, sz)
         self.kvm_run = kvm_run.from_buffer(self.mmap)
+        self._sync = self.kvm_run.s.regs
+
+        # The coalesced MMIO ring is per-VM but mapped into every vcpu.
+        self.coalesced_mmio_ring = None
+        page = self.vm.kvm.coalesced_mmio_page
+        if page:
+            self.coalesced_mmio_ring = kvm_coalesced_mmio_ring.from_buffer(
+                    self.mmap, page * mmap.PAGESIZE)
 
     def run(self):
-        t0 = time.time()
+        """Run the vcpu until an exit that isn't handled by a device bus."""
+        while True:
+            r = self._run_once(self._exit_views)
+            if not self._handle_exit(r):
+                return r
+
+    def _run_once(self, views):
+        # One KVM_RUN with everything run() does around it on entry and
+        # exit. Returns the exit, as a view from views if given.
+        if self._pending_input is not None:
+            self._input_recorder.record(self._pending_input)
+            self._pending_input = None
+        if self._reg_cache:
+            self._flush_reg_cache()
+        if self._irq_queue or self.kvm_run.request_interrupt_window:
+            self._inject_interrupt()
+        timing = self.timing
+        if timing:
+            t0 = now_ns()
         try:
             self._run()
         except KeyboardInterrupt:
             pass
-        dt = time.time() - t0
-        return KvmExit.from_vcpu(self, dt)
+        self._exits += 1
+        if timing:
+            ns = now_ns() - t0
+            dt = ns * 1e-9
+        else:
+            ns = 0
+            dt = None
+        if self._reg_cache:
+            self._cached_regs = self._cached_sregs = None
+        if self.vm.coalesced_mmio_zones:
+            with self.vm._coalesced_mmio_lock:
+                if self._input_replayer is not None:
+                    ring = self.coalesced_mmio_ring
+                    ring.first = ring.last
+                else:
+                    self.vm.mmio_bus.drain_coalesced(self.coalesced_mmio_ring)
+        if views is not None:
+            r = views[self.kvm_run.exit_reason]
+            r.dt = dt
+        else:
+            r = KvmExit.from_vcpu(self, dt)
+        if self._record_stats:
+            self.stats.record(r, ns if timing else None)
+        if self._trace is not None:
+            self._trace.record(self.cpuid, r, t0 + ns if timing else now_ns(),
+                    self.get_regs().rip if self._trace_rip else None)
+        return r
+
+    def _handle_exit(self, r):
+        # Returns True if the exit was dealt with and the vcpu should go
+        # straight back into the guest.
+        code = r.code
+        if code == KvmExit.KVM_EXIT_IRQ_WINDOW_OPEN:
+            return True
+        if code == KvmExit.KVM_EXIT_HLT and self._irq_queue and self.kvm_run.if_flag:
+            # A queued interrupt wakes the guest right away.
+            return True
+        if code == KvmExit.KVM_EXIT_IO or code == KvmExit.KVM_EXIT_MMIO:
+            if self._input_replayer is not None:
+                # Devices don't run: reads come from the log, writes
+                # are dropped.
+                if not r.is_write:
+                    self._input_replayer.replay(r)
+                return True
+            if self._input_recorder is not None and not r.is_write:
+                self._pending_input = r
+
+        if code == KvmExit.KVM_EXIT_IO and self.vm.io_bus.dispatch(r):
+            return True
+        if code == KvmExit.KVM_EXIT_MMIO and self.vm.mmio_bus.dispatch(r):
+            return True
+        return False
+
+    def queue_interrupt(self, vector, priority=None):
+        """Queue an external interrupt for injection with KVM_INTERRUPT.
+
+        For VMs without an in-kernel irqchip. Higher priorities are injected
+        first, in FIFO order within a priority; the default is the vector's
+        APIC priority class (vector >> 4). run() injects the next vector on
+        entry once the guest can take it, asking KVM for an interrupt
+        window exit only while interrupts are pending. May be called from
+        any thread; a vcpu that is in the guest picks it up on its next
+        exit.
+        """
+        if self.vm.irqchip:
+            raise KvmError('Use Vm.set_irq_line() with an in-kernel irqchip')
+        if priority is None:
+            priority = vector >> 4
+        with self._irq_lock:
+            heappush(self._irq_queue, (-priority, self._irq_seq, vector))
+            self._irq_seq += 1
+
+    def _inject_interrupt(self):
+        run = self.kvm_run
+        with self._irq_lock:
+            if self._irq_queue and run.ready_for_interrupt_injection:
+                self._interrupt(heappop(self._irq_queue)[2])
+            run.request_interrupt_window = 1 if self._irq_queue else 0
+
+    def enable_stats(self, enable=True):
+        """Record every exit in self.stats (turns timing on when enabling).
+
+        To take all timing off the hot path, also set self.timing = False;
+        exits are then counted without a latency.
+        """
+        self._record_stats = enable
+        if enable:
+            self.timing = True
+
+    def set_trace(self, recorder, rip=False):
+        """Record every exit into a pykvm.trace.TraceRecorder (None to stop).
+
+        With rip=True each record also holds the guest RIP, which costs a
+        KVM_GET_REGS per exit unless sync regs or the register cache are on.
+        """
+        self._trace = recorder
+        self._trace_rip = rip
+
+    def record_inputs(self, recorder):
+        """Log all I/O and MMIO read data into a pykvm.replay.InputRecorder.
+
+        Pass None to stop recording.
+        """
+        self._input_recorder = recorder
+        self._pending_input = None
+
+    def replay_inputs(self, replayer):
+        """Replay a log through a pykvm.replay.InputReplayer (None to stop).
+
+        While replaying, run() answers every I/O and MMIO read from the log
+        and drops writes, without dispatching to devices, so it only returns
+        on other exits.
+        """
+        self._input_replayer = replayer
+
+    def use_exit_views(self, enable=True):
+        """Make run() return preallocated exit views instead of new exits.
+
+        A view reads straight from kvm_run, so it is only valid until the
+        next call to run().
+        """
+        self._exit_views = KvmExit.views_for(self) if enable else None
+
+    def use_sync_regs(self, enable=True):
+        """Exchange regs, sregs and events through kvm_run (KVM_CAP_SYNC_REGS).
+
+        While enabled, get_regs()/get_sregs()/get_vcpu_events() return the
+        structures inside kvm_run, which KVM refreshes on every exit, and
+        set_*() marks them dirty so KVM loads them on the next run().
+        """
+        if not enable:
+            self._flush_sync_regs()
+            self.kvm_run.kvm_valid_regs = 0
+            self._sync_regs = 0
+            return
+        if self._reg_cache:
+            raise KvmError('Register cache and sync regs are mutually exclusive')
+
+        mask = kvm_sync_regs.KVM_SYNC_X86_VALID_FIELDS
+        supported = self.vm.kvm._check_extension(self.vm.kvm.KVM_CAP_SYNC_REGS)
+        if supported & mask != mask:
+            raise KvmError('KVM_CAP_SYNC_REGS not supported')
+
+        # Fill the shared area once; after that, KVM keeps it current.
+        self._ioctl(self.fd, self.KVM_GET_REGS, self._sync.regs)
+        self._ioctl(self.fd, self.KVM_GET_SREGS, self._sync.sregs)
+        self._ioctl(self.fd, self.KVM_GET_VCPU_EVENTS, self._sync.events)
+        self.kvm_run.kvm_dirty_regs = 0
+        self.kvm_run.kvm_valid_regs = mask
+        self._sync_regs = mask
+
+    def _flush_sync_regs(self):
+        dirty = self.kvm_run.kvm_dirty_regs
+        if dirty & kvm_sync_regs.KVM_SYNC_X86_REGS:
+            self._ioctl(self.fd, self.KVM_SET_REGS, self._sync.regs)
+        if dirty & kvm_sync_regs.KVM_SYNC_X86_SREGS:
+            self._ioctl(self.fd, self.KVM_SET_SREGS, self._sync.sregs)
+        if dirty & kvm_sync_regs.KVM_SYNC_X86_EVENTS:
+            self._ioctl(self.fd, self.KVM_SET_VCPU_EVENTS, self._sync.events)
+        self.kvm_run.kvm_dirty_regs = 0
+
+    def use_reg_cache(self, enable=True):
+        """Cache regs and sregs between exits.
+
+        While enabled, get_regs()/get_sregs() issue at most one ioctl per
+        exit and return the cached structure, which handlers may modify in
+        place. set_*() only update the cache. Before the next KVM_RUN, any
+        structure whose contents differ from what KVM returned is written
+        back with one KVM_SET_REGS/KVM_SET_SREGS.
+        """
+        if not enable:
+            self._flush_reg_cache()
+            self._cached_regs = self._cached_sregs = None
+            self._reg_cache = False
+            return
+        if self._sync_regs:
+            raise KvmError('Register cache and sync regs are mutually exclusive')
+        self._reg_cache = True
+
+    def _flush_reg_cache(self):
+        c = self._cached_sregs
+        if c is not None and _struct_bytes(c[0]) != c[1]:
+            self._ioctl(self.fd, self.KVM_SET_SREGS, c[0])
+            self._cached_sregs = (c[0], _struct_bytes(c[0]))
+        c = self._cached_regs
+        if c is not None and _struct_bytes(c[0]) != c[1]:
+            self._ioctl(self.fd, self.KVM_SET_REGS, c[0])
+            self._cached_regs = (c[0], _struct_bytes(c[0]))
+
+    def _set_sync(self, bit, shared, value):
+        if ctypes.addressof(value) != ctypes.addressof(shared):
+            ctypes.memmove(ctypes.addressof(shared), ctypes.addressof(value),
+                    ctypes.sizeof(shared))
+        self.kvm_run.kvm_dirty_regs |= bit
+
+    # Maximum number of cached translations before the TLB is flushed.
+    TLB_SIZE = 4096
+
+    def flush_translations(self):
+        """Drop cached translations, e.g. after the guest edits page tables."""
+        self._tlb.clear()
+
+    def _check_tlb(self, sregs):
+        crs = (sregs.cr0, sregs.cr3, sregs.cr4)
+        if crs != self._tlb_crs:
+            self._tlb.clear()
+            self._tlb_crs = crs
+
+    def translate(self, gva):
+        """Translate a guest virtual address to a guest physical address.
+
+        Translations are cached per page until CR0, CR3 or CR4 change or
+        flush_translations() is called. The first call after the guest has
+        run rereads sregs to check (free with sync regs or the register
+        cache, one KVM_GET_SREGS otherwise).
+        """
+        if self._tlb_exits != self._exits:
+            self._check_tlb(self.get_sregs())
+            self._tlb_exits = self._exits
+        page = gva & ~PAGE_MASK
+        gpa_page = self._tlb.get(page)
+        if gpa_page is None:
+            t = self._translate(page)
+            if not t.valid:
+                raise KvmError('Guest virtual address 0x{:X} is not mapped'.format(gva))
+            gpa_page = t.physical_address & ~PAGE_MASK
+            if len(self._tlb) >= self.TLB_SIZE:
+                self._tlb.clear()
+            self._tlb[page] = gpa_page
+        return gpa_page | (gva & PAGE_MASK)
+
+    def _iter_virt(self, gva, n):
+        # Yield (guest physical address, length) for each page of the range.
+        while n > 0:
+            chunk = min(n, PAGE_SIZE - (gva & PAGE_MASK))
+            yield self.translate(gva), chunk
+            gva += chunk
+            n -= chunk
+
+    def read_virt(self, gva, n):
+        """Read n bytes of guest memory at guest virtual address gva."""
+        vm = self.vm
+        return ''.join(vm.read_phys(gpa, chunk) for gpa, chunk in self._iter_virt(gva, n))
+
+    def write_virt(self, gva, data):
+        """Write a string or buffer to guest memory at guest virtual address gva."""
+        vm = self.vm
+        off = 0
+        for gpa, chunk in self._iter_virt(gva, len(data)):
+            vm.write_phys(gpa, buffer(data, off, chunk))
+            off += chunk
 
     def enable_single_step(self):
-        dbg = kvm_guest_debug()
-        dbg.control = self.KVM_GUESTDBG_ENABLE | self.KVM_GUESTDBG_SINGLESTEP 
+        self._guest_debug.control |= self.KVM_GUESTDBG_SINGLESTEP
+        self._update_guest_debug()
+
+    def disable_single_step(self):
+        self._guest_debug.control &= ~self.KVM_GUESTDBG_SINGLESTEP
+        self._update_guest_debug()
+
+    def _update_guest_debug(self):
+        # Push self._guest_debug, which single-stepping and
+        # pykvm.breakpoint.BreakpointManager share, to KVM.
+        dbg = self._guest_debug
+        if dbg.control & ~self.KVM_GUESTDBG_ENABLE:
+            dbg.control |= self.KVM_GUESTDBG_ENABLE
+        else:
+            dbg.control = 0
         self._set_guest_debug(dbg)
 
 
@@ -66,42 +411,151 @@ class Vcpu(object):
     KVM_SET_MSRS                   = 0x4008AE89
     KVM_SET_CPUID                  = 0x4008AE8A
     KVM_SET_GUEST_DEBUG            = 0x4048AE9B
+    KVM_GET_VCPU_EVENTS            = 0x8040AE9F
+    KVM_SET_VCPU_EVENTS            = 0x4040AEA0
 
     # SET_GUEST_DEBUG
     KVM_GUESTDBG_ENABLE            = 0x00000001
     KVM_GUESTDBG_SINGLESTEP        = 0x00000002
+    KVM_GUESTDBG_USE_SW_BP         = 0x00010000
+    KVM_GUESTDBG_USE_HW_BP         = 0x00020000
 
 
     def _run(self):
-        ioctl(self.fd, self.KVM_RUN)
+        # With an integer argument, fcntl.ioctl() (KernelBackend) releases
+        # the GIL around the system call, so other vcpu threads keep running
+        # Python (and their guests) while this one is in the guest.
+        self._ioctl(self.fd, self.KVM_RUN, 0)
 
     def get_regs(self):
+        if self._sync_regs & kvm_sync_regs.KVM_SYNC_X86_REGS:
+            return self._sync.regs
+        if self._reg_cache and self._cached_regs is not None:
+            return self._cached_regs[0]
         r = kvm_regs()
-        ioctl(self.fd, self.KVM_GET_REGS, r)
+        self._ioctl(self.fd, self.KVM_GET_REGS, r)
+        if self._reg_cache:
+            self._cached_regs = (r, _struct_bytes(r))
         return r
 
     def set_regs(self, regs):
-        ioctl(self.fd, self.KVM_SET_REGS, regs)
+        if self._sync_regs & kvm_sync_regs.KVM_SYNC_X86_REGS:
+            self._set_sync(kvm_sync_regs.KVM_SYNC_X86_REGS, self._sync.regs, regs)
+            return
+        if self._reg_cache:
+            self._cached_regs = _cache_update(self._cached_regs, regs)
+            return
+        self._ioctl(self.fd, self.KVM_SET_REGS, regs)
 
     def get_sregs(self):
+        if self._sync_regs & kvm_sync_regs.KVM_SYNC_X86_SREGS:
+            r = self._sync.sregs
+            self._check_tlb(r)
+            return r
+        if self._reg_cache and self._cached_sregs is not None:
+            return self._cached_sregs[0]
         r = kvm_sregs()
-        ioctl(self.fd, self.KVM_GET_SREGS, r)
+        self._ioctl(self.fd, self.KVM_GET_SREGS, r)
+        if self._reg_cache:
+            self._cached_sregs = (r, _struct_bytes(r))
+        self._check_tlb(r)
         return r
 
     def set_sregs(self, regs):
-        ioctl(self.fd, self.KVM_SET_SREGS, regs)
+        self._check_tlb(regs)
+        if self._sync_regs & kvm_sync_regs.KVM_SYNC_X86_SREGS:
+            self._set_sync(kvm_sync_regs.KVM_SYNC_X86_SREGS, self._sync.sregs, regs)
+            return
+        if self._reg_cache:
+            self._cached_sregs = _cache_update(self._cached_sregs, regs)
+            return
+        self._ioctl(self.fd, self.KVM_SET_SREGS, regs)
+
+    def get_vcpu_events(self):
+        if self._sync_regs & kvm_sync_regs.KVM_SYNC_X86_EVENTS:
+            return self._sync.events
+        r = kvm_vcpu_events()
+        self._ioctl(self.fd, self.KVM_GET_VCPU_EVENTS, r)
+        return r
+
+    def set_vcpu_events(self, events):
+        if self._sync_regs & kvm_sync_regs.KVM_SYNC_X86_EVENTS:
+            self._set_sync(kvm_sync_regs.KVM_SYNC_X86_EVENTS, self._sync.events, events)
+            return
+        self._ioctl(self.fd, self.KVM_SET_VCPU_EVENTS, events)
 
     def get_debugregs(self):
         r = kvm_debugregs()
-        ioctl(self.fd, self.KVM_GET_DEBUGREGS, r)
+        self._ioctl(self.fd, self.KVM_GET_DEBUGREGS, r)
         return r
 
     def set_debugregs(self, regs):
-        ioctl(self.fd, self.KVM_SET_DEBUGREGS, regs)
+        self._ioctl(self.fd, self.KVM_SET_DEBUGREGS, regs)
 
-    def _set_guest_debug(self, dbg):
-        ioctl(self.fd, self.KVM_SET_GUEST_DEBUG, dbg)
+    def _interrupt(self, vector):
+        self._ioctl(self.fd, self.KVM_INTERRUPT, kvm_interrupt(irq = vector))
 
+    def _set_guest_debug(self, dbg):
+        self._ioctl(self.fd, self.KVM_SET_GUEST_DEBUG, dbg)
+
+    def _msrs_buffer(self, n):
+        if len(self._msrs.entries) < n:
+            size = 16
+            while size < n:
+                size *= 2
+            self._msrs = kvm_msrs(size)()
+        self._msrs.nmsrs = n
+        return self._msrs
+
+    def get_msrs(self, indices):
+        """Read any number of MSRs with one ioctl. Returns {index: value}."""
+        n = len(indices)
+        msrs = self._msrs_buffer(n)
+        entries = msrs.entries
+        for i, index in enumerate(indices):
+            entries[i].index = index
+        got = self._ioctl(self.fd, self.KVM_GET_MSRS, msrs)
+        if got != n:
+            raise KvmError('Failed to read MSR 0x{:X}'.format(indices[got]))
+        return dict((entries[i].index, entries[i].data) for i in xrange(n))
+
+    def set_msrs(self, values):
+        """Write a {index: value} dict of MSRs with one ioctl."""
+        items = values.items()
+        done = self._put_msrs(items)
+        if done != len(items):
+            raise KvmError('Failed to write MSR 0x{:X}'.format(items[done][0]))
+
+    def _put_msrs(self, items):
+        # Returns the number of (index, value) items KVM accepted, in order.
+        msrs = self._msrs_buffer(len(items))
+        entries = msrs.entries
+        for i, (index, data) in enumerate(items):
+            entries[i].index = index
+            entries[i].data = data
+        return self._ioctl(self.fd, self.KVM_SET_MSRS, msrs)
+
+    def _translate(self, gva):
+        if self._reg_cache:
+            # KVM must see any pending CR0/CR3/CR4 change.
+            self._flush_reg_cache()
+        t = kvm_translation(linear_address = gva)
+        self._ioctl(self.fd, self.KVM_TRANSLATE, t)
+        return t
+
+
+
+def _struct_bytes(s):
+    return ctypes.string_at(ctypes.addressof(s), ctypes.sizeof(s))
+
+def _cache_update(cached, value):
+    # New (struct, fetched bytes) cache entry after a set_*() call.
+    if cached is None:
+        return (type(value).from_buffer_copy(value), None)
+    if value is not cached[0]:
+        ctypes.memmove(ctypes.addressof(cached[0]), ctypes.addressof(value),
+                ctypes.sizeof(value))
+    return cached
 
 
 class Memslot(object):
@@ -110,24 +564,252 @@ class Memslot(object):
         self.guest_phys_addr = guest_phys_addr
         self.buffer_obj = buffer_obj
         self.readonly = readonly
+        # Whether userspace may write the buffer; read-only mmaps can't be.
+        self.writable = _buffer_writable(buffer_obj)
+        self.log_dirty = False
+        self._dirty_bitmap = None
 
     def __str__(self):
-        return '<Memslot #{}: 0x{:X}-0x{:X}{}>'.format(self.slotnum,
+        return '<Memslot #{}: 0x{:X}-0x{:X}{}{}>'.format(self.slotnum,
                 self.guest_phys_addr, self.guest_phys_addr + self.size,
-                ' Readonly ' if self.readonly else '',)
+                ' Readonly ' if self.readonly else '',
+                ' LogDirty ' if self.log_dirty else '',)
 
     @property
     def size(self):
         return len(self.buffer_obj)
 
+    @property
+    def num_pages(self):
+        return (self.size + PAGE_SIZE - 1) // PAGE_SIZE
+
+    @property
+    def dirty_bitmap(self):
+        # One bit per page, in 64-bit words; allocated once and reused.
+        if self._dirty_bitmap is None:
+            self._dirty_bitmap = (c_uint64 * ((self.num_pages + 63) // 64))()
+        return self._dirty_bitmap
+
     @property
     def userspace_addr(self):
         return addressof_buffer(self.buffer_obj)
 
 
+class Checkpoint(object):
+    """Saved vcpu and guest memory state of a Vm. See Vm.checkpoint()."""
+
+    def __init__(self, vm):
+        self.vcpu_state = dict((cpuid, _save_vcpu_state(vcpu))
+                for cpuid, vcpu in vm.vcpus.iteritems())
+
+        # Read-only slots can't be changed by the guest; don't copy them.
+        self.memory = []
+        for ms in vm.memslots:
+            if ms.readonly:
+                continue
+            saved = mmap.mmap(-1, ms.size)
+            ctypes.memmove(addressof_buffer(saved), ms.userspace_addr, ms.size)
+            self.memory.append((ms, saved))
+
+    def __str__(self):
+        return '<Checkpoint: {} vcpus, {} memslots>'.format(
+                len(self.vcpu_state), len(self.memory))
+
+    def restore_vcpus(self, vm):
+        for cpuid, state in self.vcpu_state.iteritems():
+            _load_vcpu_state(vm.vcpus[cpuid], state)
+
+    def restore_memory(self, vm, incremental):
+        """Copy saved memory back. Returns the number of pages copied."""
+        n = 0
+        for ms, saved in self.memory:
+            dst = ms.userspace_addr
+            src = addressof_buffer(saved)
+            if not incremental:
+                ctypes.memmove(dst, src, ms.size)
+                vm.get_dirty_pages(ms.slotnum)
+                n += ms.num_pages
+                continue
+            for page, count in _iter_runs(iter_set_bits(vm.get_dirty_pages(ms.slotnum))):
+                off = page << PAGE_SHIFT
+                ctypes.memmove(dst + off, src + off, count << PAGE_SHIFT)
+                n += count
+        return n
+
+
+class VmTemplate(object):
+    """Frozen vcpu and memory state of a Vm. See Kvm.create_vm_from_template().
+
+    Writable memslots are copied once into unlinked files; VMs created from
+    the template map those MAP_PRIVATE, so their RAM is shared copy-on-write
+    with the template and creating one copies no guest memory. Read-only
+    memslots share the template VM's buffer directly; file mappings made by
+    add_file_region() stay mapped until the template, the VM and all the
+    clones sharing them are closed.
+    """
+
+    def __init__(self, vm):
+        self.name = vm.name
+        self.vcpu_state = dict((cpuid, _save_vcpu_state(vcpu))
+                for cpuid, vcpu in vm.vcpus.iteritems())
+
+        # (guest_phys_addr, size, readonly, buffer_obj or file)
+        self.memory = []
+        self._mappings = []
+        for ms in vm.memslots:
+            if ms.readonly:
+                self.memory.append((ms.guest_phys_addr, ms.size, True, ms.buffer_obj))
+                mapping = getattr(ms.buffer_obj, '_mapping', None)
+                if mapping is not None:
+                    self._mappings.append(mapping.hold())
+                continue
+            f = tempfile.TemporaryFile(dir=_shm_dir)
+            f.truncate(ms.size)
+            m = mmap.mmap(f.fileno(), ms.size, mmap.MAP_SHARED, mmap.PROT_READ|mmap.PROT_WRITE)
+            ctypes.memmove(addressof_buffer(m), ms.userspace_addr, ms.size)
+            m.close()
+            self.memory.append((ms.guest_phys_addr, ms.size, False, f))
+
+    def __str__(self):
+        return '<VmTemplate: name={} {} vcpus, {} memslots>'.format(
+                self.name, len(self.vcpu_state), len(self.memory))
+
+    def close(self):
+        """Release the template's memory. VMs already created from it keep working."""
+        for gpa, size, readonly, backing in self.memory:
+            if not readonly:
+                backing.close()
+        self.memory = []
+        for m in self._mappings:
+            m.close()
+        self._mappings = []
+
+    def map_memory(self):
+        """Yield (guest_phys_addr, buffer_obj, readonly) for a new VM."""
+        for gpa, size, readonly, backing in self.memory:
+            if readonly:
+                yield gpa, backing, True
+            else:
+                m = mmap.mmap(backing.fileno(), size, mmap.MAP_PRIVATE,
+                        mmap.PROT_READ|mmap.PROT_WRITE)
+                yield gpa, m, False
+
+
+_shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+def _save_vcpu_state(vcpu):
+    # Copies, since the getters may return structures inside kvm_run.
+    return (
+        kvm_regs.from_buffer_copy(vcpu.get_regs()),
+        kvm_sregs.from_buffer_copy(vcpu.get_sregs()),
+        kvm_debugregs.from_buffer_copy(vcpu.get_debugregs()),
+        kvm_vcpu_events.from_buffer_copy(vcpu.get_vcpu_events()),
+        _save_msrs(vcpu),
+    )
+
+def _save_msrs(vcpu):
+    return vcpu.get_msrs(vcpu.vm.kvm.get_msr_index_list())
+
+def _load_msrs(vcpu, msrs):
+    # Some listed MSRs (e.g. KVM paravirtual ones the guest's CPUID doesn't
+    # advertise) can be read but not written. Drop those from the saved
+    # dict as KVM refuses them, so later restores are a single KVM_SET_MSRS.
+    items = msrs.items()
+    while True:
+        done = vcpu._put_msrs(items)
+        if done == len(items):
+            return
+        del msrs[items[done][0]]
+        del items[:done+1]
+
+def _load_vcpu_state(vcpu, state):
+    regs, sregs, debugregs, events, msrs = state
+    vcpu.set_sregs(sregs)
+    vcpu.set_regs(regs)
+    vcpu.set_debugregs(debugregs)
+    vcpu.set_vcpu_events(events)
+    _load_msrs(vcpu, msrs)
+
+def _iter_runs(pages):
+    # Group ascending page numbers into (first, count) runs.
+    start = None
+    for p in pages:
+        if start is not None and p == start + count:
+            count += 1
+            continue
+        if start is not None:
+            yield start, count
+        start, count = p, 1
+    if start is not None:
+        yield start, count
+
+
+PAGE_SIZE = mmap.PAGESIZE
+PAGE_SHIFT = PAGE_SIZE.bit_length() - 1
+PAGE_MASK = PAGE_SIZE - 1
+
 def addressof_buffer(b):
     # This seems like a hack, but I could find no better way.
-    return ctypes.addressof(ctypes.c_void_p.from_buffer(b))
+    try:
+        return ctypes.addressof(ctypes.c_void_p.from_buffer(b))
+    except TypeError:
+        pass
+    # Read-only buffers (e.g. an ACCESS_READ mmap) refuse from_buffer().
+    addr = ctypes.c_void_p()
+    size = ctypes.c_ssize_t()
+    ctypes.pythonapi.PyObject_AsReadBuffer(ctypes.py_object(b),
+            ctypes.byref(addr), ctypes.byref(size))
+    return addr.value
+
+def _buffer_writable(b):
+    try:
+        ctypes.c_char.from_buffer(b)
+    except TypeError:
+        return False
+    return True
+
+def _source_buffer(data):
+    # A ctypes object holding data's bytes. Strings and writable buffers
+    # (bytearray, mmap, ctypes arrays) are not copied.
+    if isinstance(data, str):
+        return ctypes.c_char_p(data)
+    try:
+        return (ctypes.c_char * len(data)).from_buffer(data)
+    except TypeError:
+        return ctypes.c_char_p(memoryview(data).tobytes())
+
+def _source_addr(src):
+    return ctypes.cast(src, ctypes.c_void_p).value
+
+
+def irqchip_route(gsi, irqchip, pin):
+    """A GSI route to an in-kernel irqchip pin, for Vm.set_gsi_routing()."""
+    e = kvm_irq_routing_entry(gsi = gsi, type = kvm_irq_routing_entry.KVM_IRQ_ROUTING_IRQCHIP)
+    e.u.irqchip.irqchip = irqchip
+    e.u.irqchip.pin = pin
+    return e
+
+def msi_route(gsi, address, data):
+    """A GSI route that sends an MSI, for Vm.set_gsi_routing()."""
+    e = kvm_irq_routing_entry(gsi = gsi, type = kvm_irq_routing_entry.KVM_IRQ_ROUTING_MSI)
+    e.u.msi.address_lo = address & 0xFFFFFFFF
+    e.u.msi.address_hi = address >> 32
+    e.u.msi.data = data
+    return e
+
+def default_gsi_routing():
+    """KVM's initial routing: GSIs 0-15 to both PICs and the IOAPIC,
+    GSIs 16-23 to the IOAPIC only.
+    """
+    e = kvm_irq_routing_entry
+    routes = []
+    for gsi in xrange(24):
+        if gsi < 8:
+            routes.append(irqchip_route(gsi, e.KVM_IRQCHIP_PIC_MASTER, gsi))
+        elif gsi < 16:
+            routes.append(irqchip_route(gsi, e.KVM_IRQCHIP_PIC_SLAVE, gsi - 8))
+        routes.append(irqchip_route(gsi, e.KVM_IRQCHIP_IOAPIC, gsi))
+    return routes
 
 
 class Vm(object):
@@ -135,15 +817,73 @@ class Vm(object):
         self.kvm = kvm
         self.fd = fd
         self.name = name
+        self._ioctl = kvm.backend.ioctl
 
         self.vcpus = {}
 
         self.memslots = []
+        self._checkpoint = None
+
+        # Memslots sorted by guest physical address, for phys_*() lookups.
+        self._slot_starts = []
+        self._slot_ends = []
+        self._slot_addrs = []
+        self._slots = []
+
+        self.io_bus = IoBus()
+        self.mmio_bus = MmioBus()
+        self.stats = VmStats(self)
+        # Defaults for vcpus added later; see VmStats.enable().
+        self.timing = True
+        self._record_stats = False
+        self.coalesced_mmio_zones = []
+        self._coalesced_mmio_lock = threading.Lock()
+
+        self.irqchip = False
+        self.pit = False
+        self.gsi_routes = None
+
+        self._ioeventfds = {}   # EventFd -> kvm_ioeventfd
+        self._irqfds = {}       # EventFd -> gsi
+
+        # Mappings this VM created or shares for its memslots, released by
+        # close().
+        self._mappings = []
 
 
     def __str__(self):
         return '<Vm: fd={} name={}>'.format(self.fd, self.name)
 
+    def close(self):
+        """Destroy the VM: close its vcpus and fd and unmap the memory it mapped.
+
+        Memslot buffers passed to add_mem_region() belong to the caller and
+        are left alone. Those created by add_file_region() or for a clone are
+        unmapped once no template or clone shares them, and must not be used
+        through this VM afterwards. The VM is removed from kvm.vms.
+        """
+        if self.fd is None:
+            return
+        for vcpu in self.vcpus.itervalues():
+            vcpu.close()
+        self.kvm.backend.close(self.fd)
+        self.fd = None
+
+        self.memslots = []
+        self._slot_starts = []
+        self._slot_ends = []
+        self._slot_addrs = []
+        self._slots = []
+        self._checkpoint = None
+        self._ioeventfds.clear()
+        self._irqfds.clear()
+        for m in self._mappings:
+            m.close()
+        self._mappings = []
+
+        if self in self.kvm.vms:
+            self.kvm.vms.remove(self)
+
     def add_vcpu(self, cpuid):
         if cpuid in self.vcpus:
             raise KvmError('vcpu with id {} already exists'.format(cpuid))
@@ -152,6 +892,39 @@ class Vm(object):
         self.vcpus[cpuid] = vcpu
         return vcpu
 
+    def run_all(self, handler):
+        """Run every vcpu in its own thread.
+
+        Each thread calls handler(vcpu, exit) for every exit returned by
+        Vcpu.run(), and stops when it returns False. If a handler raises,
+        the other threads stop at their next exit, and the first exception
+        is re-raised here once all the threads are done.
+        """
+        errors = []
+
+        def vcpu_thread(vcpu):
+            try:
+                while not errors and handler(vcpu, vcpu.run()):
+                    pass
+            except Exception:
+                errors.append(sys.exc_info())
+
+        threads = []
+        for cpuid, vcpu in sorted(self.vcpus.iteritems()):
+            t = threading.Thread(target=vcpu_thread, args=(vcpu,),
+                    name='{} vcpu{}'.format(self.name, cpuid))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            # join() without a timeout would block KeyboardInterrupt.
+            while t.is_alive():
+                t.join(0.1)
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
     def add_mem_region(self, guest_phys_addr, buffer_obj, readonly=False):
         if len(self.memslots) >= self.kvm.max_memslots:
             raise KvmError('Maximum number of memory slots ({}) already assigned.'\
@@ -161,26 +934,317 @@ class Vm(object):
         self.update_mem_region(ms)
         self.memslots.append(ms)
 
+        i = bisect_right(self._slot_starts, guest_phys_addr)
+        self._slot_starts.insert(i, guest_phys_addr)
+        self._slot_ends.insert(i, guest_phys_addr + ms.size)
+        self._slot_addrs.insert(i, ms.userspace_addr)
+        self._slots.insert(i, ms)
+        return ms
+
+    def add_file_region(self, guest_phys_addr, f, size=None, offset=0,
+            readonly=True, shared=False):
+        """Map a file (e.g. a firmware, kernel or disk image) as a new memslot.
+
+        Nothing is read or copied up front; see pykvm.map_file(). By default
+        the slot is read-only to the guest (KVM_MEM_READONLY: writes become
+        MMIO exits). Otherwise guest writes go to a private copy of each
+        page, or with shared, to the file itself.
+        """
+        buf = map_file(f, size, offset, shared)
+        ms = self.add_mem_region(guest_phys_addr, buf, readonly)
+        self._mappings.append(buf._mapping)
+        return ms
+
+    def _phys_lookup(self, gpa):
+        i = bisect_right(self._slot_starts, gpa) - 1
+        if i < 0 or gpa >= self._slot_ends[i]:
+            raise KvmError('No memslot at guest physical address 0x{:X}'.format(gpa))
+        return i
+
+    def _iter_phys(self, gpa, n):
+        # Yield (memslot, host address, length) pieces of [gpa, gpa+n),
+        # which may span adjacent memslots.
+        while n > 0:
+            i = self._phys_lookup(gpa)
+            chunk = min(n, self._slot_ends[i] - gpa)
+            yield self._slots[i], self._slot_addrs[i] + (gpa - self._slot_starts[i]), chunk
+            gpa += chunk
+            n -= chunk
+
+    def phys_view(self, gpa, n):
+        """Return a writable memoryview of n bytes of guest memory at gpa.
+
+        No data is copied. The range must lie within a single memslot whose
+        buffer is writable; use read_phys() for read-only mappings.
+        """
+        i = self._phys_lookup(gpa)
+        if gpa + n > self._slot_ends[i]:
+            raise KvmError('Range 0x{:X}+0x{:X} crosses the end of {}'.format(
+                gpa, n, self._slots[i]))
+        ms = self._slots[i]
+        if not ms.writable:
+            raise KvmError('{} is not writable'.format(ms))
+        return memoryview((ctypes.c_char * n).from_buffer(ms.buffer_obj,
+                gpa - ms.guest_phys_addr))
+
+    def read_phys(self, gpa, n):
+        """Read n bytes of guest memory at guest physical address gpa."""
+        i = self._phys_lookup(gpa)
+        off = gpa - self._slot_starts[i]
+        if gpa + n <= self._slot_ends[i]:
+            return ctypes.string_at(self._slot_addrs[i] + off, n)
+        return ''.join(ctypes.string_at(addr, chunk)
+                for ms, addr, chunk in self._iter_phys(gpa, n))
+
+    def write_phys(self, gpa, data):
+        """Write a string or buffer to guest memory at guest physical address gpa."""
+        n = len(data)
+        src = _source_buffer(data)
+        i = self._phys_lookup(gpa)
+        if gpa + n <= self._slot_ends[i]:
+            if not self._slots[i].writable:
+                raise KvmError('{} is not writable'.format(self._slots[i]))
+            ctypes.memmove(self._slot_addrs[i] + (gpa - self._slot_starts[i]), src, n)
+            return
+        pieces = list(self._iter_phys(gpa, n))
+        for ms, addr, chunk in pieces:
+            if not ms.writable:
+                raise KvmError('{} is not writable'.format(ms))
+        src_addr = _source_addr(src)
+        for ms, addr, chunk in pieces:
+            ctypes.memmove(addr, src_addr, chunk)
+            src_addr += chunk
+
+    def set_dirty_logging(self, slot, enable=True):
+        """Turn KVM dirty page logging on or off for memslot number slot."""
+        ms = self.memslots[slot]
+        ms.log_dirty = enable
+        self.update_mem_region(ms)
+
+    def get_dirty_pages(self, slot):
+        """Fetch and clear the dirty page bitmap of memslot number slot.
+
+        Returns the memslot's c_uint64 bitmap array (bit n set means page n
+        of the slot was written); it is overwritten by the next call.
+        """
+        ms = self.memslots[slot]
+        if not ms.log_dirty:
+            raise KvmError('Dirty logging is not enabled for {}'.format(ms))
+        bitmap = ms.dirty_bitmap
+        self._get_dirty_log(slot, ctypes.addressof(bitmap))
+        return bitmap
+
+    def make_template(self):
+        """Return a VmTemplate of this VM's current state."""
+        return VmTemplate(self)
+
+    def clone(self, name=''):
+        """Create a copy-on-write clone of this VM.
+
+        Devices on the I/O and MMIO buses are not cloned. This copies guest
+        RAM once into a fresh template; to create many clones of the same
+        state, call make_template() once and use Kvm.create_vm_from_template().
+        """
+        return self.kvm.create_vm_from_template(self.make_template(), name)
+
+    def checkpoint(self):
+        """Save vcpu registers and guest memory, and start dirty logging.
+
+        Returns a Checkpoint for restore(). Restoring the most recent
+        checkpoint only copies back the pages the guest has dirtied since
+        the checkpoint (or the last restore). Writes made to guest memory
+        from userspace are not seen by KVM's dirty log and are not undone.
+        """
+        for ms in self.memslots:
+            if not ms.readonly and not ms.log_dirty:
+                self.set_dirty_logging(ms.slotnum)
+        cp = Checkpoint(self)
+        # Start the dirty log afresh from the state we just saved.
+        for ms, saved in cp.memory:
+            self.get_dirty_pages(ms.slotnum)
+        self._checkpoint = cp
+        return cp
+
+    def restore(self, cp=None):
+        """Reset the VM to a Checkpoint (by default, the most recent one).
+
+        Returns the number of guest pages copied.
+        """
+        if cp is None:
+            cp = self._checkpoint
+            if cp is None:
+                raise KvmError('No checkpoint to restore')
+        n = cp.restore_memory(self, incremental = cp is self._checkpoint)
+        cp.restore_vcpus(self)
+        self._checkpoint = cp
+        return n
+
+    def iter_dirty_pfns(self, slot):
+        """Fetch and clear the dirty log of a memslot; yield dirty guest PFNs."""
+        base_pfn = self.memslots[slot].guest_phys_addr >> PAGE_SHIFT
+        for page in iter_set_bits(self.get_dirty_pages(slot)):
+            yield base_pfn + page
+
+
+    def add_coalesced_mmio(self, addr, size):
+        """Let KVM queue guest writes to [addr, addr+size) without exiting.
+
+        The queued writes are delivered to vm.mmio_bus in one batch after
+        the next exit of any vcpu, before that exit is dispatched.
+        """
+        if not self.kvm.coalesced_mmio_page:
+            raise KvmError('KVM_CAP_COALESCED_MMIO not supported')
+        self._register_coalesced_mmio(addr, size)
+        self.coalesced_mmio_zones.append((addr, size))
+
+    def remove_coalesced_mmio(self, addr, size):
+        self.coalesced_mmio_zones.remove((addr, size))
+        self._unregister_coalesced_mmio(addr, size)
+
+    def create_irqchip(self):
+        """Create the in-kernel PIC, IOAPIC and local APICs.
+
+        The guest's interrupt controller accesses, interrupt acknowledges
+        and HLTs are then handled without exits to userspace; devices raise
+        interrupts with set_irq_line(). Must be called before add_vcpu().
+        """
+        if self.vcpus:
+            raise KvmError('The irqchip must be created before any vcpu')
+        if self.irqchip:
+            raise KvmError('irqchip already created')
+        self._ioctl(self.fd, self.KVM_CREATE_IRQCHIP)
+        self.irqchip = True
+        self.gsi_routes = default_gsi_routing()
+
+    def create_pit2(self, speaker_dummy=False):
+        """Create the in-kernel i8254 PIT (ports 0x40-0x43) on GSI 0.
+
+        With speaker_dummy, KVM also claims port 0x61. Requires
+        create_irqchip().
+        """
+        if not self.irqchip:
+            raise KvmError('The PIT requires an in-kernel irqchip')
+        cfg = kvm_pit_config()
+        if speaker_dummy:
+            cfg.flags = kvm_pit_config.KVM_PIT_SPEAKER_DUMMY
+        self._ioctl(self.fd, self.KVM_CREATE_PIT2, cfg)
+        self.pit = True
+
+    def set_irq_line(self, gsi, level):
+        """Set the level of an in-kernel irqchip input.
+
+        Returns KVM's status: > 0 if the interrupt was delivered, 0 if it
+        was coalesced with one still pending, < 0 if it was masked.
+        """
+        r = kvm_irq_level(irq = gsi, level = level)
+        self._ioctl(self.fd, self.KVM_IRQ_LINE_STATUS, r)
+        return ctypes.c_int32(r.irq).value
+
+    def pulse_irq(self, gsi):
+        """Raise and lower a line, i.e. one edge-triggered interrupt."""
+        status = self.set_irq_line(gsi, 1)
+        self.set_irq_line(gsi, 0)
+        return status
+
+    def set_gsi_routing(self, routes):
+        """Replace the GSI routing table with a list of kvm_irq_routing_entry.
+
+        See irqchip_route() and msi_route(). create_irqchip() starts out
+        with default_gsi_routing().
+        """
+        r = kvm_irq_routing(len(routes))(nr = len(routes))
+        for i, route in enumerate(routes):
+            r.entries[i] = route
+        self._ioctl(self.fd, self.KVM_SET_GSI_ROUTING, r)
+        self.gsi_routes = list(routes)
+
+    def add_ioeventfd(self, addr, length, datamatch=None, pio=False, efd=None):
+        """Have KVM signal an eventfd on guest writes, instead of exiting.
+
+        addr is a guest physical (MMIO) address, or an I/O port with
+        pio=True. With datamatch, only writes of that value count. Returns
+        the EventFd (a new one unless efd is given); see
+        pykvm.eventfd.watch() for servicing it from an event loop.
+        """
+        if efd is None:
+            efd = EventFd()
+        r = kvm_ioeventfd(addr = addr, len = length, fd = efd.fileno())
+        if datamatch is not None:
+            r.datamatch = datamatch
+            r.flags |= kvm_ioeventfd.KVM_IOEVENTFD_FLAG_DATAMATCH
+        if pio:
+            r.flags |= kvm_ioeventfd.KVM_IOEVENTFD_FLAG_PIO
+        self._ioctl(self.fd, self.KVM_IOEVENTFD, r)
+        self._ioeventfds[efd] = r
+        return efd
+
+    def remove_ioeventfd(self, efd):
+        r = self._ioeventfds.pop(efd)
+        r.flags |= kvm_ioeventfd.KVM_IOEVENTFD_FLAG_DEASSIGN
+        self._ioctl(self.fd, self.KVM_IOEVENTFD, r)
+
+    def add_irqfd(self, gsi, efd=None):
+        """Raise GSI gsi (an edge) each time an eventfd is written.
+
+        Any thread or process holding the EventFd can then interrupt the
+        guest without going through a vcpu. Requires create_irqchip().
+        Returns the EventFd (a new one unless efd is given).
+        """
+        if not self.irqchip:
+            raise KvmError('irqfd requires an in-kernel irqchip')
+        if efd is None:
+            efd = EventFd()
+        self._ioctl(self.fd, self.KVM_IRQFD, kvm_irqfd(fd = efd.fileno(), gsi = gsi))
+        self._irqfds[efd] = gsi
+        return efd
+
+    def remove_irqfd(self, efd):
+        gsi = self._irqfds.pop(efd)
+        self._ioctl(self.fd, self.KVM_IRQFD, kvm_irqfd(fd = efd.fileno(), gsi = gsi,
+            flags = kvm_irqfd.KVM_IRQFD_FLAG_DEASSIGN))
 
     def update_mem_region(self, ms):
         flags = 0
         if ms.readonly:
             flags |= kvm_userspace_memory_region.KVM_MEM_READONLY 
+        if ms.log_dirty:
+            flags |= kvm_userspace_memory_region.KVM_MEM_LOG_DIRTY_PAGES
         self._set_user_memory_region(ms.slotnum, flags, ms.guest_phys_addr, ms.size, ms.userspace_addr)
 
 
     # IOCTLs
     KVM_CREATE_VCPU                = 0x0000AE41
+    KVM_GET_DIRTY_LOG              = 0x4010AE42
     KVM_SET_USER_MEMORY_REGION     = 0x4020AE46
+    KVM_REGISTER_COALESCED_MMIO    = 0x4010AE67
+    KVM_UNREGISTER_COALESCED_MMIO  = 0x4010AE68
+    KVM_CREATE_IRQCHIP             = 0x0000AE60
+    KVM_SET_GSI_ROUTING            = 0x4008AE6A
+    KVM_IRQ_LINE_STATUS            = 0xC008AE67
+    KVM_CREATE_PIT2                = 0x4040AE77
+    KVM_IRQFD                      = 0x4020AE76
+    KVM_IOEVENTFD                  = 0x4040AE79
 
     def _create_vcpu(self, cpuid):
-        return ioctl(self.fd, self.KVM_CREATE_VCPU, cpuid)
+        return self._ioctl(self.fd, self.KVM_CREATE_VCPU, cpuid)
 
     def _set_user_memory_region(self, slot, flags, guest_phys_addr, memory_size, userspace_addr):
         r = kvm_userspace_memory_region(
                 slot = slot, flags = flags, guest_phys_addr = guest_phys_addr,
                 memory_size = memory_size, userspace_addr = userspace_addr)
-        ioctl(self.fd, self.KVM_SET_USER_MEMORY_REGION, r)
+        self._ioctl(self.fd, self.KVM_SET_USER_MEMORY_REGION, r)
+
+    def _get_dirty_log(self, slot, bitmap_addr):
+        r = kvm_dirty_log(slot = slot, dirty_bitmap = bitmap_addr)
+        self._ioctl(self.fd, self.KVM_GET_DIRTY_LOG, r)
+
+    def _register_coalesced_mmio(self, addr, size):
+        z = kvm_coalesced_mmio_zone(addr = addr, size = size)
+        self._ioctl(self.fd, self.KVM_REGISTER_COALESCED_MMIO, z)
+
+    def _unregister_coalesced_mmio(self, addr, size):
+        z = kvm_coalesced_mmio_zone(addr = addr, size = size)
+        self._ioctl(self.fd, self.KVM_UNREGISTER_COALESCED_MMIO, z)
 
 
 
@@ -190,12 +1254,17 @@ class Vm(object):
 class Kvm(object):
     KVM_API_VERSION = 12
 
-    def __init__(self):
-        self.fd = os.open('/dev/kvm', os.O_RDWR)
+    def __init__(self, backend=None):
+        """Open KVM through a backend (by default, KernelBackend: /dev/kvm)."""
+        self.backend = backend or KernelBackend()
+        self._ioctl = self.backend.ioctl
+        self.fd = self.backend.open()
         self.vms = []
+        self._msr_index_list = None
 
         self._check_api_version()
         self.max_memslots = self._check_extension(self.KVM_CAP_NR_MEMSLOTS)
+        self.coalesced_mmio_page = self._check_extension(self.KVM_CAP_COALESCED_MMIO)
 
     def _check_api_version(self):
         ver = self._get_api_version() 
@@ -206,6 +1275,12 @@ class Kvm(object):
         for name, cap in sorted(self._caps.iteritems()):
             yield (name, self._check_extension(cap))
 
+    def get_msr_index_list(self):
+        """Return the MSRs KVM saves and restores, as a tuple of indices."""
+        if self._msr_index_list is None:
+            self._msr_index_list = tuple(self._get_msr_index_list())
+        return self._msr_index_list
+
     def create_vm(self, name=''):
         fd = self._create_vm()
         vm = Vm(self, fd, name)
@@ -213,6 +1288,19 @@ class Kvm(object):
         return vm
 
 
+    def create_vm_from_template(self, template, name=''):
+        vm = self.create_vm(name)
+        for gpa, buffer_obj, readonly in template.map_memory():
+            vm.add_mem_region(gpa, buffer_obj, readonly)
+            if not readonly:
+                vm._mappings.append(buffer_obj)
+            elif getattr(buffer_obj, '_mapping', None) is not None:
+                vm._mappings.append(buffer_obj._mapping.hold())
+        for cpuid, state in sorted(template.vcpu_state.iteritems()):
+            _load_vcpu_state(vm.add_vcpu(cpuid), state)
+        return vm
+
+
     # IOCTLs
     KVM_GET_API_VERSION            = 0x0000AE00
     KVM_CREATE_VM                  = 0x0000AE01
@@ -221,16 +1309,28 @@ class Kvm(object):
     KVM_GET_VCPU_MMAP_SIZE         = 0x0000AE04
 
     def _get_api_version(self):
-        return ioctl(self.fd, Kvm.KVM_GET_API_VERSION) 
+        return self._ioctl(self.fd, Kvm.KVM_GET_API_VERSION) 
 
     def _get_vcpu_mmap_size(self):
-        return ioctl(self.fd, Kvm.KVM_GET_VCPU_MMAP_SIZE)
+        return self._ioctl(self.fd, Kvm.KVM_GET_VCPU_MMAP_SIZE)
 
     def _check_extension(self, cap):
-        return ioctl(self.fd, Kvm.KVM_CHECK_EXTENSION, cap)
+        return self._ioctl(self.fd, Kvm.KVM_CHECK_EXTENSION, cap)
 
     def _create_vm(self):
-        return ioctl(self.fd, Kvm.KVM_CREATE_VM, 0)
+        return self._ioctl(self.fd, Kvm.KVM_CREATE_VM, 0)
+
+    def _get_msr_index_list(self):
+        # Ask with no room first; KVM fails with E2BIG and fills in nmsrs.
+        probe = kvm_msr_list(0)()
+        try:
+            self._ioctl(self.fd, Kvm.KVM_GET_MSR_INDEX_LIST, probe)
+        except IOError as e:
+            if e.errno != errno.E2BIG:
+                raise
+        r = kvm_msr_list(probe.nmsrs)(nmsrs = probe.nmsrs)
+        self._ioctl(self.fd, Kvm.KVM_GET_MSR_INDEX_LIST, r)
+        return r.indices[:r.nmsrs]
 
 
     KVM_CAP_IRQCHIP = 0
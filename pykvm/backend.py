@@ -0,0 +1,233 @@
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+#
+# Backends provide the primitives pykvm needs from the system: opening the
+# KVM device, ioctl(), mapping a vcpu's kvm_run area and closing fds.
+
+import os
+import errno
+import mmap
+import ctypes
+from fcntl import ioctl
+
+from kvmstructs import *
+from exitreason import KvmExit
+
+
+class KernelBackend(object):
+    """The real thing: /dev/kvm."""
+
+    def open(self):
+        return os.open('/dev/kvm', os.O_RDWR)
+
+    ioctl = staticmethod(ioctl)
+
+    def mmap_vcpu(self, fd, size):
+        # http://stackoverflow.com/a/3640617
+        return mmap.mmap(fd, size, mmap.MAP_SHARED, (mmap.PROT_READ|mmap.PROT_WRITE))
+
+    close = staticmethod(os.close)
+
+
+# Loopback script entries: (exit_reason, {kvm_run field: value}, io data).
+# Build them with the helpers below.
+
+def io_out(port, size, value, count=1):
+    return (KvmExit.KVM_EXIT_IO, {'direction': kvm_run.KVM_EXIT_IO_OUT,
+        'size': size, 'port': port, 'count': count}, (value, size))
+
+def io_in(port, size, count=1):
+    return (KvmExit.KVM_EXIT_IO, {'direction': kvm_run.KVM_EXIT_IO_IN,
+        'size': size, 'port': port, 'count': count}, None)
+
+def mmio_write(addr, size, value):
+    return (KvmExit.KVM_EXIT_MMIO, {'phys_addr': addr, 'len': size,
+        'is_write': 1, 'data': value}, None)
+
+def mmio_read(addr, size):
+    return (KvmExit.KVM_EXIT_MMIO, {'phys_addr': addr, 'len': size,
+        'is_write': 0}, None)
+
+def hlt():
+    return (KvmExit.KVM_EXIT_HLT, {}, None)
+
+
+class LoopbackBackend(object):
+    """A scripted, pure-userspace stand-in for /dev/kvm.
+
+    KVM_RUN writes the next exit of the script into the vcpu's kvm_run and
+    returns immediately, so Kvm, Vm, Vcpu, the device buses and the
+    instrumentation can be exercised and profiled without KVM. Each vcpu
+    walks the script on its own, from the start; when it runs out, the
+    vcpu gets KVM_EXIT_SHUTDOWN, or the script starts over if repeat is
+    set. Register ioctls keep per-vcpu state; memory is never touched.
+    """
+
+    MMAP_SIZE = 3 * mmap.PAGESIZE
+    IO_DATA_OFFSET = mmap.PAGESIZE
+
+    def __init__(self, script, repeat=False, caps=None):
+        self._script = [self._prepare(e) for e in script]
+        self.repeat = repeat
+        self.caps = caps or {}
+        self._fds = {}          # fd -> per-object state dict
+        self._next_fd = 1 << 20
+        self._handlers = None
+
+    def _prepare(self, entry):
+        # Render a script entry into (offset, bytes) chunks of kvm_run.
+        code, fields, io_data = entry
+        r = kvm_run(exit_reason = code)
+        io = code == KvmExit.KVM_EXIT_IO
+        for name, value in fields.iteritems():
+            if name == 'data':
+                ctypes.memmove(r.mmio.data, ctypes.byref(c_uint64(value)), 8)
+            else:
+                setattr(r.io if io else r.mmio, name, value)
+        if io:
+            r.io.data_offset = self.IO_DATA_OFFSET
+        # The guest can always take an interrupt.
+        r.ready_for_interrupt_injection = 1
+        r.if_flag = 1
+        # Only the fields KVM writes on exit, not the inputs around them.
+        start = kvm_run.exit_reason.offset
+        chunks = [(start, buffer(r)[start:kvm_run.kvm_valid_regs.offset])]
+        if io_data is not None:
+            value, size = io_data
+            data = ctypes.string_at(ctypes.byref(c_uint64(value)), size)
+            chunks.append((self.IO_DATA_OFFSET, data * fields['count']))
+        return chunks
+
+    def _new_fd(self, **state):
+        fd = self._next_fd
+        self._next_fd += 1
+        self._fds[fd] = state
+        return fd
+
+    def open(self):
+        return self._new_fd(kind='kvm')
+
+    def mmap_vcpu(self, fd, size):
+        m = mmap.mmap(-1, size)
+        st = self._fds[fd]
+        st['run_addr'] = ctypes.addressof(ctypes.c_char.from_buffer(m))
+        st['mmap'] = m
+        return m
+
+    def close(self, fd):
+        del self._fds[fd]
+
+    def ioctl(self, fd, req, arg=0):
+        if self._handlers is None:
+            self._handlers = self._make_handlers()
+        h = self._handlers.get(req)
+        if h is None:
+            raise IOError(errno.ENOTTY, os.strerror(errno.ENOTTY))
+        return h(self._fds[fd], arg)
+
+    def _make_handlers(self):
+        from pykvm import Kvm, Vm, Vcpu
+
+        def check_extension(st, cap):
+            if cap in self.caps:
+                return self.caps[cap]
+            if cap == Kvm.KVM_CAP_NR_MEMSLOTS:
+                return 32
+            return 0
+
+        def msr_index_list(st, r):
+            r.nmsrs = 0
+            return 0
+
+        def create_vm(st, arg):
+            return self._new_fd(kind='vm')
+
+        def create_vcpu(st, cpuid):
+            return self._new_fd(kind='vcpu', pos=0, regs=kvm_regs(), sregs=kvm_sregs(),
+                    debugregs=kvm_debugregs(), events=kvm_vcpu_events(), msrs={})
+
+        def run(st, arg):
+            pos = st['pos']
+            if pos == len(self._script):
+                if not self.repeat or not self._script:
+                    ctypes.c_uint32.from_address(st['run_addr'] + kvm_run.exit_reason.offset)\
+                        .value = KvmExit.KVM_EXIT_SHUTDOWN
+                    return 0
+                pos = 0
+            addr = st['run_addr']
+            for off, data in self._script[pos]:
+                ctypes.memmove(addr + off, data, len(data))
+            st['pos'] = pos + 1
+            return 0
+
+        def getter(name):
+            def get(st, r):
+                v = st[name]
+                ctypes.memmove(ctypes.addressof(r), ctypes.addressof(v), ctypes.sizeof(v))
+                return 0
+            return get
+
+        def setter(name):
+            def set(st, r):
+                st[name] = type(r).from_buffer_copy(r)
+                return 0
+            return set
+
+        def get_msrs(st, m):
+            for i in xrange(m.nmsrs):
+                m.entries[i].data = st['msrs'].get(m.entries[i].index, 0)
+            return m.nmsrs
+
+        def set_msrs(st, m):
+            for i in xrange(m.nmsrs):
+                st['msrs'][m.entries[i].index] = m.entries[i].data
+            return m.nmsrs
+
+        def translate(st, t):
+            t.physical_address = t.linear_address
+            t.valid = 1
+            t.writeable = 1
+            return 0
+
+        def get_dirty_log(st, r):
+            # The loopback guest never writes memory; the bitmap stays clear.
+            return 0
+
+        def irq_line_status(st, r):
+            r.irq = 1
+            return 0
+
+        def ok(st, arg):
+            return 0
+
+        return {
+            Kvm.KVM_GET_API_VERSION:        lambda st, arg: Kvm.KVM_API_VERSION,
+            Kvm.KVM_CHECK_EXTENSION:        check_extension,
+            Kvm.KVM_GET_VCPU_MMAP_SIZE:     lambda st, arg: self.MMAP_SIZE,
+            Kvm.KVM_GET_MSR_INDEX_LIST:     msr_index_list,
+            Kvm.KVM_CREATE_VM:              create_vm,
+            Vm.KVM_CREATE_VCPU:             create_vcpu,
+            Vm.KVM_SET_USER_MEMORY_REGION:  ok,
+            Vm.KVM_GET_DIRTY_LOG:           get_dirty_log,
+            Vm.KVM_CREATE_IRQCHIP:          ok,
+            Vm.KVM_CREATE_PIT2:             ok,
+            Vm.KVM_IRQ_LINE_STATUS:         irq_line_status,
+            Vm.KVM_SET_GSI_ROUTING:         ok,
+            Vm.KVM_IOEVENTFD:               ok,
+            Vm.KVM_IRQFD:                   ok,
+            Vcpu.KVM_RUN:                   run,
+            Vcpu.KVM_GET_REGS:              getter('regs'),
+            Vcpu.KVM_SET_REGS:              setter('regs'),
+            Vcpu.KVM_GET_SREGS:             getter('sregs'),
+            Vcpu.KVM_SET_SREGS:             setter('sregs'),
+            Vcpu.KVM_GET_DEBUGREGS:         getter('debugregs'),
+            Vcpu.KVM_SET_DEBUGREGS:         setter('debugregs'),
+            Vcpu.KVM_GET_VCPU_EVENTS:       getter('events'),
+            Vcpu.KVM_SET_VCPU_EVENTS:       setter('events'),
+            Vcpu.KVM_GET_MSRS:              get_msrs,
+            Vcpu.KVM_SET_MSRS:              set_msrs,
+            Vcpu.KVM_TRANSLATE:             translate,
+            Vcpu.KVM_SET_GUEST_DEBUG:       ok,
+            Vcpu.KVM_INTERRUPT:             ok,
+        }
@@ -0,0 +1,25 @@
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+
+import re
+
+# Bit positions set in each byte value, LSB first.
+_byte_bits = tuple(tuple(b for b in xrange(8) if v & (1 << b)) for v in xrange(256))
+
+_nonzero_run = re.compile(r'[^\x00]+')
+
+def iter_set_bits(bitmap):
+    """Yield the indices of the set bits in a little-endian bitmap.
+
+    bitmap is any buffer (e.g. a ctypes array of c_uint64). Runs of zero
+    bytes are skipped by the regex engine in C, and set bytes are expanded
+    through a lookup table, so only the set bits cost Python work.
+    """
+    data = buffer(bitmap)
+    for m in _nonzero_run.finditer(data):
+        base = m.start() * 8
+        for c in m.group():
+            for b in _byte_bits[ord(c)]:
+                yield base + b
+            base += 8
@@ -0,0 +1,196 @@
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+#
+# Breakpoints and watchpoints backed by the debug registers (DR0-DR3),
+# with int3 software breakpoints once those run out.
+
+from kvmstructs import *
+from exitreason import KvmExit
+from errors import KvmError
+
+# x86 exception vectors
+DB_VECTOR = 1
+BP_VECTOR = 3
+
+DR6_BS = (1<<14)        # single step
+DR7_GE = (1<<9)
+
+NUM_SLOTS = 4
+
+# DR7 LEN encodings
+_dr7_len = {1: 0, 2: 1, 8: 2, 4: 3}
+
+# Lowest of the DR6 B0-B3 bits -> slot
+_dr6_slot = (None,) + tuple((i & -i).bit_length() - 1 for i in xrange(1, 16))
+
+
+class Breakpoint(object):
+    # Kinds (DR7 R/W encodings)
+    EXEC    = 0
+    WRITE   = 1
+    ACCESS  = 3     # read or write
+
+    _kind_names = {EXEC: 'exec', WRITE: 'write', ACCESS: 'access'}
+
+    def __init__(self, addr, kind, length):
+        self.addr = addr
+        self.kind = kind
+        self.length = length
+        self.slot = None        # DR0-DR3 index; None for a software breakpoint
+        self.hits = 0
+        self._orig = None       # byte under a software breakpoint's int3
+        self._armed = True
+
+    @property
+    def hardware(self):
+        return self.slot is not None
+
+    def __str__(self):
+        return '<Breakpoint: {} 0x{:X} ({} bytes, {})>'.format(
+                self._kind_names[self.kind], self.addr, self.length,
+                'DR{}'.format(self.slot) if self.hardware else 'int3')
+
+
+class BreakpointManager(object):
+    """Breakpoints and watchpoints on one vcpu.
+
+    Each breakpoint takes one of DR0-DR3. When all four are in use, execute
+    breakpoints fall back to software breakpoints (an int3 written into
+    guest memory, so it is visible to the guest); watchpoints can't, and
+    add() raises KvmError. Addresses are guest linear addresses.
+
+    A hit shows up as a KVM_EXIT_DEBUG exit from Vcpu.run(); lookup() maps
+    it to its Breakpoint. To resume after an execute breakpoint, call
+    step_over(). With software breakpoints in place, the guest's own int3
+    instructions also exit to userspace, and lookup() returns None for them.
+    """
+
+    def __init__(self, vcpu):
+        self.vcpu = vcpu
+        self._slots = [None] * NUM_SLOTS
+        self._sw = {}           # addr -> software Breakpoint
+
+    def __iter__(self):
+        for bp in self._slots:
+            if bp is not None:
+                yield bp
+        for bp in self._sw.itervalues():
+            yield bp
+
+    def add(self, addr, kind=Breakpoint.EXEC, length=1):
+        """Set a breakpoint (kind EXEC) or watchpoint (WRITE or ACCESS).
+
+        Watchpoints cover length (1, 2, 4 or 8) bytes at an address aligned
+        to length. Returns the new Breakpoint.
+        """
+        if kind == Breakpoint.EXEC:
+            length = 1
+        elif kind not in (Breakpoint.WRITE, Breakpoint.ACCESS):
+            raise ValueError('Invalid breakpoint kind: {}'.format(kind))
+        if length not in _dr7_len or addr % length:
+            raise KvmError('Invalid watchpoint: 0x{:X} ({} bytes)'.format(addr, length))
+
+        bp = Breakpoint(addr, kind, length)
+        if None in self._slots:
+            bp.slot = self._slots.index(None)
+            self._slots[bp.slot] = bp
+        elif kind == Breakpoint.EXEC:
+            if addr in self._sw:
+                raise KvmError('Breakpoint already set at 0x{:X}'.format(addr))
+            self._insert_int3(bp)
+            self._sw[addr] = bp
+        else:
+            raise KvmError('No free debug register for watchpoint at 0x{:X}'.format(addr))
+        self._apply()
+        return bp
+
+    def remove(self, bp):
+        if bp.hardware:
+            self._slots[bp.slot] = None
+            bp.slot = None
+        else:
+            if self._sw.get(bp.addr) is not bp:
+                raise KvmError('Unknown breakpoint: {}'.format(bp))
+            del self._sw[bp.addr]
+            if bp._armed:
+                self._remove_int3(bp)
+        self._apply()
+
+    def clear(self):
+        for bp in list(self):
+            self.remove(bp)
+
+    def lookup(self, exit):
+        """Return the Breakpoint that caused a KVM_EXIT_DEBUG exit, or None.
+
+        None means the exit wasn't one of ours, e.g. a single step.
+        """
+        if exit.exception == BP_VECTOR:
+            bp = self._sw.get(exit.pc)
+        else:
+            slot = _dr6_slot[exit.dr6 & 0xF]
+            bp = None if slot is None else self._slots[slot]
+        if bp is not None:
+            bp.hits += 1
+        return bp
+
+    def step_over(self, bp):
+        """Execute the instruction under execute breakpoint bp, then re-arm it.
+
+        Returns None, or an exit that stopped the vcpu before the
+        instruction completed.
+        """
+        vcpu = self.vcpu
+        self._disarm(bp)
+        vcpu.enable_single_step()
+        try:
+            r = vcpu.run()
+        finally:
+            vcpu.disable_single_step()
+            self._arm(bp)
+        if r.code == KvmExit.KVM_EXIT_DEBUG and r.dr6 & DR6_BS:
+            return None
+        return r
+
+    def _disarm(self, bp):
+        bp._armed = False
+        if bp.hardware:
+            self._apply()
+        else:
+            self._remove_int3(bp)
+
+    def _arm(self, bp):
+        bp._armed = True
+        if bp.hardware:
+            self._apply()
+        else:
+            self._insert_int3(bp)
+
+    def _insert_int3(self, bp):
+        vcpu = self.vcpu
+        bp._orig = vcpu.read_virt(bp.addr, 1)
+        vcpu.write_virt(bp.addr, '\xCC')
+
+    def _remove_int3(self, bp):
+        self.vcpu.write_virt(bp.addr, bp._orig)
+
+    def _apply(self):
+        vcpu = self.vcpu
+        dbg = vcpu._guest_debug
+        debugreg = dbg.arch.debugreg
+        dr7 = 0
+        for i, bp in enumerate(self._slots):
+            if bp is None or not bp._armed:
+                debugreg[i] = 0
+                continue
+            debugreg[i] = bp.addr
+            dr7 |= (2 << (2*i)) | (bp.kind << (16 + 4*i)) | (_dr7_len[bp.length] << (18 + 4*i))
+        debugreg[7] = dr7 | DR7_GE if dr7 else 0
+
+        dbg.control &= ~(vcpu.KVM_GUESTDBG_USE_HW_BP | vcpu.KVM_GUESTDBG_USE_SW_BP)
+        if dr7:
+            dbg.control |= vcpu.KVM_GUESTDBG_USE_HW_BP
+        if self._sw:
+            dbg.control |= vcpu.KVM_GUESTDBG_USE_SW_BP
+        vcpu._update_guest_debug()
@@ -0,0 +1,189 @@
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+
+from bisect import bisect_right
+
+from kvmstructs import *
+from errors import KvmError
+
+# KVM splits MMIO accesses that cross a page into fragments of any length
+# up to 8 bytes, so MMIO data goes through a c_uint64 and a mask.
+_masks = tuple((1 << (8 * n)) - 1 for n in xrange(9))
+
+
+class Device(object):
+    """Base class for emulated devices attached to an IoBus or MmioBus.
+
+    Unimplemented reads return all-ones, like an unclaimed ISA port, and
+    unimplemented writes are dropped.
+    """
+
+    def io_read(self, port, size):
+        return (1 << (size * 8)) - 1
+
+    def io_write(self, port, size, value):
+        pass
+
+    def mmio_read(self, addr, size):
+        return (1 << (size * 8)) - 1
+
+    def mmio_write(self, addr, size, value):
+        pass
+
+
+class IoBus(object):
+    """Routes port I/O exits to the devices that own the ports.
+
+    Lookups go through a dense table with one entry per port, so dispatch
+    cost does not depend on the number of registered devices.
+    """
+    NUM_PORTS = 0x10000
+
+    def __init__(self):
+        self._table = [None] * self.NUM_PORTS
+        self.regions = {}           # base -> (length, device)
+
+    def __str__(self):
+        return '<IoBus: {} regions>'.format(len(self.regions))
+
+    def register(self, base, length, device):
+        if length <= 0 or base < 0 or base + length > self.NUM_PORTS:
+            raise KvmError('Invalid port range 0x{:X}+0x{:X}'.format(base, length))
+        for port in xrange(base, base + length):
+            if self._table[port] is not None:
+                raise KvmError('Port 0x{:X} already registered'.format(port))
+        self._table[base:base+length] = [device] * length
+        self.regions[base] = (length, device)
+
+    def unregister(self, base):
+        if base not in self.regions:
+            raise KvmError('No port region at 0x{:X}'.format(base))
+        length, device = self.regions.pop(base)
+        self._table[base:base+length] = [None] * length
+
+    def lookup(self, port):
+        return self._table[port]
+
+    def dispatch(self, exit):
+        """Handle a KvmExitIo. Returns False if no device owns the port."""
+        port = exit.port
+        device = self._table[port]
+        if device is None:
+            return False
+
+        size = exit.size
+        ctype = uint_types[size]
+        addr = exit.data_addr
+        if exit.is_write:
+            for i in xrange(exit.count):
+                device.io_write(port, size, ctype.from_address(addr).value)
+                addr += size
+        else:
+            for i in xrange(exit.count):
+                ctype.from_address(addr).value = device.io_read(port, size)
+                addr += size
+        return True
+
+
+class MmioBus(object):
+    """Routes MMIO exits to the devices that own guest-physical ranges.
+
+    Regions are kept in a sorted interval index (parallel lists of start,
+    end and device), so a lookup is a single bisect.
+    """
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+        self._devices = []
+
+    def __str__(self):
+        return '<MmioBus: {} regions>'.format(len(self._starts))
+
+    def register(self, base, length, device):
+        if length <= 0 or base < 0:
+            raise KvmError('Invalid MMIO range 0x{:X}+0x{:X}'.format(base, length))
+        end = base + length
+        i = bisect_right(self._starts, base)
+        if (i > 0 and self._ends[i-1] > base) or \
+                (i < len(self._starts) and self._starts[i] < end):
+            raise KvmError('MMIO range 0x{:X}-0x{:X} overlaps an existing region'\
+                    .format(base, end))
+        self._starts.insert(i, base)
+        self._ends.insert(i, end)
+        self._devices.insert(i, device)
+
+    def unregister(self, base):
+        i = bisect_right(self._starts, base) - 1
+        if i < 0 or self._starts[i] != base:
+            raise KvmError('No MMIO region at 0x{:X}'.format(base))
+        del self._starts[i]
+        del self._ends[i]
+        del self._devices[i]
+
+    @property
+    def regions(self):
+        return zip(self._starts, self._ends, self._devices)
+
+    def lookup(self, addr):
+        i = bisect_right(self._starts, addr) - 1
+        if i >= 0 and addr < self._ends[i]:
+            return self._devices[i]
+        return None
+
+    def region_base(self, addr):
+        i = bisect_right(self._starts, addr) - 1
+        if i >= 0 and addr < self._ends[i]:
+            return self._starts[i]
+        return None
+
+    def dispatch(self, exit):
+        """Handle a KvmExitMmio. Returns False if no device owns the address."""
+        addr = exit.phys_addr
+        i = bisect_right(self._starts, addr) - 1
+        if i < 0 or addr >= self._ends[i]:
+            return False
+        device = self._devices[i]
+
+        size = exit.len
+        data_addr = exit.data_addr
+        if exit.is_write:
+            device.mmio_write(addr, size, c_uint64.from_address(data_addr).value & _masks[size])
+            return True
+        value = device.mmio_read(addr, size)
+        ctype = uint_types.get(size)
+        if ctype is not None:
+            ctype.from_address(data_addr).value = value
+        else:
+            ctypes.memmove(data_addr, ctypes.byref(c_uint64(value & _masks[size])), size)
+        return True
+
+    def drain_coalesced(self, ring):
+        """Deliver the writes queued in a kvm_coalesced_mmio_ring, in order.
+
+        Writes to addresses no device owns are dropped. Returns the number
+        of ring entries consumed.
+        """
+        first = ring.first
+        last = ring.last
+        if first == last:
+            return 0
+
+        starts = self._starts
+        ends = self._ends
+        devices = self._devices
+        entries = ring.coalesced_mmio
+        n = 0
+        while first != last:
+            e = entries[first]
+            addr = e.phys_addr
+            i = bisect_right(starts, addr) - 1
+            if i >= 0 and addr < ends[i]:
+                size = e.len
+                value = c_uint64.from_buffer(e.data).value & _masks[size]
+                devices[i].mmio_write(addr, size, value)
+            first = (first + 1) % KVM_COALESCED_MMIO_MAX
+            n += 1
+        ring.first = first
+        return n
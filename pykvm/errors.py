@@ -0,0 +1,6 @@
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+
+class KvmError(Exception):
+    pass
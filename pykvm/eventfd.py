@@ -0,0 +1,123 @@
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+#
+# eventfds for ioeventfd/irqfd, and a small epoll loop to service them.
+# Python 2 has neither os.eventfd() nor asyncio, so eventfd(2) is called
+# through libc and EventLoop offers asyncio's add_reader()/remove_reader()
+# interface; watch() works with it or with any loop that has those.
+
+import os
+import errno
+import select
+import struct
+import ctypes
+
+EFD_NONBLOCK = 0o4000
+EFD_CLOEXEC  = 0o2000000
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_counter = struct.Struct('=Q')
+
+
+class EventFd(object):
+    """A nonblocking Linux eventfd: a 64-bit counter behind a file descriptor."""
+
+    def __init__(self, initval=0):
+        fd = _libc.eventfd(initval, EFD_NONBLOCK | EFD_CLOEXEC)
+        if fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.fd = fd
+
+    def __str__(self):
+        return '<EventFd: fd={}>'.format(self.fd)
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Return and reset the counter; 0 if it was already 0."""
+        try:
+            return _counter.unpack(os.read(self.fd, 8))[0]
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            return 0
+
+    def write(self, n=1):
+        """Add n to the counter."""
+        os.write(self.fd, _counter.pack(n))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class EventLoop(object):
+    """A minimal epoll reactor with asyncio's add_reader() interface.
+
+    run_forever() dispatches callbacks on the calling thread until stop(),
+    which may be called from any thread (or a callback).
+    """
+
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._readers = {}
+        self._stopping = False
+        self._wakeup = EventFd()
+        self.add_reader(self._wakeup.fileno(), self._wakeup.read)
+
+    def add_reader(self, fd, callback, *args):
+        if hasattr(fd, 'fileno'):
+            fd = fd.fileno()
+        if fd in self._readers:
+            self._epoll.modify(fd, select.EPOLLIN)
+        else:
+            self._epoll.register(fd, select.EPOLLIN)
+        self._readers[fd] = (callback, args)
+
+    def remove_reader(self, fd):
+        if hasattr(fd, 'fileno'):
+            fd = fd.fileno()
+        if self._readers.pop(fd, None) is None:
+            return False
+        self._epoll.unregister(fd)
+        return True
+
+    def run_forever(self):
+        self._stopping = False
+        while not self._stopping:
+            try:
+                events = self._epoll.poll()
+            except IOError as e:
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+            for fd, mask in events:
+                r = self._readers.get(fd)
+                if r is not None:
+                    r[0](*r[1])
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup.write()
+
+    def close(self):
+        self._epoll.close()
+        self._wakeup.close()
+
+
+def watch(loop, efd, callback):
+    """Call callback(count) from loop whenever efd is signalled.
+
+    loop is an EventLoop or any loop with add_reader() (e.g. asyncio's).
+    The counter is drained before the call, so one callback may cover
+    several guest writes.
+    """
+    def ready():
+        n = efd.read()
+        if n:
+            callback(n)
+    loop.add_reader(efd.fileno(), ready)
@@ -3,6 +3,26 @@
 # (C) 2015 Jonathon Reinhart
 
 from kvmstructs import *
+from errors import KvmError
+
+
+class _live(object):
+    """Like property(), but an instance attribute of the same name wins.
+
+    Exit views evaluate these against kvm_run on every access. Snapshot exits
+    copy the values out of kvm_run in their constructor, and the instance
+    attributes shadow the descriptors.
+    """
+    def __init__(self, fget):
+        self.fget = fget
+        self.__name__ = fget.__name__
+        self.__doc__ = fget.__doc__
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return self.fget(obj)
+
 
 class KvmExit(object):
     # Exit reasons
@@ -34,14 +54,34 @@ class KvmExit(object):
     def __init__(self):
         raise Exception('Use from_vcpu() factory method')
 
+    @classmethod
+    def _new(cls, vcpu):
+        r = cls.__new__(cls)
+        r._bind(vcpu)
+        return r
+
+    def _bind(self, vcpu):
+        pass
+
     @classmethod
     def from_vcpu(cls, vcpu, dt):
-        subclasses = dict((c.code, c) for c in cls.__subclasses__())
-        r = subclasses[vcpu.kvm_run.exit_reason](vcpu)
+        """Return a new exit object holding a copy of the current exit info."""
+        r = _exit_classes[vcpu.kvm_run.exit_reason](vcpu)
         r.dt = dt
         return r
 
+    @classmethod
+    def views_for(cls, vcpu):
+        """Return a {exit_reason: exit view} dict for a vcpu.
+
+        A view is allocated once and reads its fields straight out of
+        vcpu.kvm_run, so it is only valid until the next Vcpu.run().
+        """
+        return dict((code, c._new(vcpu)) for code, c in _exit_classes.iteritems())
+
     def __str__(self):
+        if self.dt is None:
+            return 'KVM Exit: ' + self._getstr()
         return 'KVM Exit (dt = {:.06f} ms): '.format(self.dt * 1000) + self._getstr()
 
 
@@ -51,6 +91,13 @@ class KvmExitUnknown(KvmExit):
     def __init__(self, vcpu):
         self.hardware_exit_reason = vcpu.kvm_run.hw.hardware_exit_reason
 
+    def _bind(self, vcpu):
+        self._hw = vcpu.kvm_run.hw
+
+    @_live
+    def hardware_exit_reason(self):
+        return self._hw.hardware_exit_reason
+
     def _getstr(self):
         return 'Unknown reason. Hardware reason: 0x{:X}'.format(self.hardware_exit_reason)
 
@@ -58,8 +105,20 @@ class KvmExitException(KvmExit):
     code = KvmExit.KVM_EXIT_EXCEPTION
 
     def __init__(self, vcpu):
-        self.exception = vcpu.kvm_run.ex.exception
-        self.error_code = vcpud.kvm_run.ex.error_code
+        ex = vcpu.kvm_run.ex
+        self.exception = ex.exception
+        self.error_code = ex.error_code
+
+    def _bind(self, vcpu):
+        self._ex = vcpu.kvm_run.ex
+
+    @_live
+    def exception(self):
+        return self._ex.exception
+
+    @_live
+    def error_code(self):
+        return self._ex.error_code
 
     def _getstr(self):
         return 'Exception: 0x{:X}, error code: 0x{:X}'.format(self.exception, self.error_code)
@@ -77,8 +136,38 @@ class KvmExitIo(KvmExit):
         self.count = io.count
 
         # TODO: Should the accessors deal with integers or strings?
-        self.data = (c_uint8 * self.size).from_address(
-                ctypes.addressof(vcpu.kvm_run) + io.data_offset)
+        self.data_addr = ctypes.addressof(vcpu.kvm_run) + io.data_offset
+        self.data = (c_uint8 * self.size).from_address(self.data_addr)
+
+    def _bind(self, vcpu):
+        self.vcpu = vcpu
+        self._io = vcpu.kvm_run.io
+        self._run_addr = ctypes.addressof(vcpu.kvm_run)
+
+    @_live
+    def is_write(self):
+        return self._io.direction == kvm_run.KVM_EXIT_IO_OUT
+
+    @_live
+    def size(self):
+        return self._io.size
+
+    @_live
+    def port(self):
+        return self._io.port
+
+    @_live
+    def count(self):
+        return self._io.count
+
+    @_live
+    def data(self):
+        io = self._io
+        return (c_uint8 * io.size).from_address(self._run_addr + io.data_offset)
+
+    @_live
+    def data_addr(self):
+        return self._run_addr + self._io.data_offset
 
     def _getstr(self):
         s = 'IO: {} port 0x{:X} ({} bytes)'.format(
@@ -115,12 +204,70 @@ class KvmExitHlt(KvmExit):
     def _getstr(self):
         return 'Halted.'
 
+class KvmExitIrqWindowOpen(KvmExit):
+    code = KvmExit.KVM_EXIT_IRQ_WINDOW_OPEN
+
+    def __init__(self, vcpu):
+        pass
+
+    def _getstr(self):
+        return 'Interrupt window open.'
+
+class KvmExitShutdown(KvmExit):
+    code = KvmExit.KVM_EXIT_SHUTDOWN
+
+    def __init__(self, vcpu):
+        pass
+
+    def _getstr(self):
+        return 'Shutdown.'
+
+class KvmExitDebug(KvmExit):
+    code = KvmExit.KVM_EXIT_DEBUG
+
+    def __init__(self, vcpu):
+        d = vcpu.kvm_run.debug.arch
+        self.exception = d.exception
+        self.pc = d.pc
+        self.dr6 = d.dr6
+        self.dr7 = d.dr7
+
+    def _bind(self, vcpu):
+        self._debug = vcpu.kvm_run.debug.arch
+
+    @_live
+    def exception(self):
+        return self._debug.exception
+
+    @_live
+    def pc(self):
+        return self._debug.pc
+
+    @_live
+    def dr6(self):
+        return self._debug.dr6
+
+    @_live
+    def dr7(self):
+        return self._debug.dr7
+
+    def _getstr(self):
+        return 'Debug: exception {}  PC: 0x{:X}  DR6: 0x{:X}  DR7: 0x{:X}'.format(
+                self.exception, self.pc, self.dr6, self.dr7)
+
 class KvmExitFailEntry(KvmExit):
     code = KvmExit.KVM_EXIT_FAIL_ENTRY
 
     def __init__(self, vcpu):
         self.hardware_entry_failure_reason = vcpu.kvm_run.fail_entry.hardware_entry_failure_reason
 
+    def _bind(self, vcpu):
+        self._fail_entry = vcpu.kvm_run.fail_entry
+
+    @_live
+    def hardware_entry_failure_reason(self):
+        return self._fail_entry.hardware_entry_failure_reason
+
     def _getstr(self):
         return 'Entry Failure. Hardware reason: 0x{:X}'.format(self.hardware_entry_failure_reason)
 
@@ -131,13 +278,49 @@ class KvmExitMmio(KvmExit):
         m = vcpu.kvm_run.mmio
         self.phys_addr = m.phys_addr
         self.data = m.data
+        self.data_addr = ctypes.addressof(self.data)
         self.len = m.len
         self.is_write = bool(m.is_write)
 
+    def _bind(self, vcpu):
+        self._mmio = vcpu.kvm_run.mmio
+        self.data_addr = ctypes.addressof(self._mmio.data)
+
+    @_live
+    def phys_addr(self):
+        return self._mmio.phys_addr
+
+    @_live
+    def data(self):
+        return self._mmio.data
+
+    @_live
+    def len(self):
+        return self._mmio.len
+
+    @_live
+    def is_write(self):
+        return bool(self._mmio.is_write)
+
     def _getstr(self):
-        return 'MMIO: {} 0x{:X} ({} bytes)'.format(
+        s = 'MMIO: {} 0x{:X} ({} bytes)'.format(
                 'Write to' if self.is_write else 'Read from',
                 self.phys_addr, self.len)
+        if self.is_write:
+            s += '  Data: ' + self.get_data().encode('hex')
+        return s
+
+    def get_data(self):
+        if not self.is_write:
+            raise KvmError('Cannot get data from MMIO read')
+        return ctypes.string_at(self.data_addr, self.len)
+
+    def set_data(self, data):
+        if self.is_write:
+            raise KvmError('Cannot set data for MMIO write')
+        if len(data) != self.len:
+            raise KvmError('data must be exactly {} bytes'.format(self.len))
+        ctypes.memmove(self.data_addr, data, len(data))
 
 class KvmExitIntr(KvmExit):
     code = KvmExit.KVM_EXIT_INTR
@@ -156,6 +339,18 @@ class KvmExitInternalError(KvmExit):
         self.suberror = i.suberror
         self.data = i.data[:i.ndata]
 
+    def _bind(self, vcpu):
+        self._internal = vcpu.kvm_run.internal
+
+    @_live
+    def suberror(self):
+        return self._internal.suberror
+
+    @_live
+    def data(self):
+        i = self._internal
+        return i.data[:i.ndata]
+
     def _getstr(self):
         suberr_str = self.err_map.get(self.suberror)
         if not suberr_str:
@@ -175,3 +370,10 @@ class KvmExitInternalError(KvmExit):
         KVM_INTERNAL_ERROR_SIMUL_EX:    'Unexpected simultaneous exceptions encountered',
         KVM_INTERNAL_ERROR_DELIVERY_EV: 'Unexpected vm-exit due to delivery event encountered',
     }
+
+
+# Built once at import time; from_vcpu() runs on every exit.
+_exit_classes = dict((c.code, c) for c in KvmExit.__subclasses__())
+
+exit_reason_names = dict((v, k) for k, v in vars(KvmExit).iteritems()
+        if k.startswith('KVM_EXIT_'))
@@ -3,7 +3,15 @@
 # (C) 2015 Jonathon Reinhart
 
 import ctypes
-from ctypes import Structure, Union, c_uint8, c_uint16, c_uint32, c_uint64
+from ctypes import Structure, Union, c_uint8, c_uint16, c_uint32, c_uint64, c_int32
+
+# Unsigned integer type by size in bytes.
+uint_types = {
+    1:  c_uint8,
+    2:  c_uint16,
+    4:  c_uint32,
+    8:  c_uint64,
+}
 
 class kvm_regs(Structure):
     _fields_ = [
@@ -232,8 +240,58 @@ class kvm_run_exit_info_union(Union):
     ]
 
 
+class kvm_vcpu_events(Structure):
+    _fields_ = [
+        ('exception', mkstruct(
+            ('injected',        c_uint8),
+            ('nr',              c_uint8),
+            ('has_error_code',  c_uint8),
+            ('pending',         c_uint8),
+            ('error_code',      c_uint32),
+            )),
+        ('interrupt', mkstruct(
+            ('injected',        c_uint8),
+            ('nr',              c_uint8),
+            ('soft',            c_uint8),
+            ('shadow',          c_uint8),
+            )),
+        ('nmi', mkstruct(
+            ('injected',        c_uint8),
+            ('pending',         c_uint8),
+            ('masked',          c_uint8),
+            ('pad',             c_uint8),
+            )),
+        ('sipi_vector',     c_uint32),
+        ('flags',           c_uint32),
+        ('smi', mkstruct(
+            ('smm',             c_uint8),
+            ('pending',         c_uint8),
+            ('smm_inside_nmi',  c_uint8),
+            ('latched_init',    c_uint8),
+            )),
+        ('reserved',        c_uint8 * 27),
+        ('exception_has_payload', c_uint8),
+        ('exception_payload', c_uint64),
+    ]
+
+    KVM_VCPUEVENT_VALID_NMI_PENDING = (1<<0)
+    KVM_VCPUEVENT_VALID_SIPI_VECTOR = (1<<1)
+    KVM_VCPUEVENT_VALID_SHADOW      = (1<<2)
+    KVM_VCPUEVENT_VALID_SMM         = (1<<3)
+
+
 class kvm_sync_regs__x86(Structure):
-    _fields_ = [ ]
+    _fields_ = [
+        ('regs',            kvm_regs),
+        ('sregs',           kvm_sregs),
+        ('events',          kvm_vcpu_events),
+    ]
+
+    # kvm_run.kvm_valid_regs / kvm_dirty_regs
+    KVM_SYNC_X86_REGS       = (1<<0)
+    KVM_SYNC_X86_SREGS      = (1<<1)
+    KVM_SYNC_X86_EVENTS     = (1<<2)
+    KVM_SYNC_X86_VALID_FIELDS = KVM_SYNC_X86_REGS | KVM_SYNC_X86_SREGS | KVM_SYNC_X86_EVENTS
 
 kvm_sync_regs = kvm_sync_regs__x86
 
@@ -287,6 +345,82 @@ class kvm_userspace_memory_region(Structure):
     KVM_MEM_READONLY        = (1<<1)
 
 
+class kvm_translation(Structure):
+    _fields_ = [
+        # in
+        ('linear_address',      c_uint64),
+
+        # out
+        ('physical_address',    c_uint64),
+        ('valid',               c_uint8),
+        ('writeable',           c_uint8),
+        ('usermode',            c_uint8),
+        ('pad',                 c_uint8 * 5),
+    ]
+
+
+class kvm_msr_entry(Structure):
+    _fields_ = [
+        ('index',           c_uint32),
+        ('reserved',        c_uint32),
+        ('data',            c_uint64),
+    ]
+
+_kvm_msrs_types = {}
+
+def kvm_msrs(n):
+    """Return the kvm_msrs structure type with room for n entries."""
+    t = _kvm_msrs_types.get(n)
+    if t is None:
+        t = _kvm_msrs_types[n] = type('kvm_msrs', (Structure,), {'_fields_': [
+            ('nmsrs',       c_uint32),
+            ('pad',         c_uint32),
+            ('entries',     kvm_msr_entry * n),
+        ]})
+    return t
+
+def kvm_msr_list(n):
+    """Return the kvm_msr_list structure type with room for n indices."""
+    return type('kvm_msr_list', (Structure,), {'_fields_': [
+        ('nmsrs',           c_uint32),
+        ('indices',         c_uint32 * n),
+    ]})
+
+
+class kvm_dirty_log(Structure):
+    _fields_ = [
+        ('slot',            c_uint32),
+        ('padding1',        c_uint32),
+        ('dirty_bitmap',    c_uint64),  # void *
+    ]
+
+
+class kvm_coalesced_mmio_zone(Structure):
+    _fields_ = [
+        ('addr',            c_uint64),
+        ('size',            c_uint32),
+        ('pad',             c_uint32),
+    ]
+
+class kvm_coalesced_mmio(Structure):
+    _fields_ = [
+        ('phys_addr',       c_uint64),
+        ('len',             c_uint32),
+        ('pad',             c_uint32),
+        ('data',            c_uint8 * 8),
+    ]
+
+KVM_COALESCED_MMIO_PAGE_SIZE = 4096
+KVM_COALESCED_MMIO_MAX = (KVM_COALESCED_MMIO_PAGE_SIZE - 8) / ctypes.sizeof(kvm_coalesced_mmio)
+
+class kvm_coalesced_mmio_ring(Structure):
+    _fields_ = [
+        ('first',           c_uint32),
+        ('last',            c_uint32),
+        ('coalesced_mmio',  kvm_coalesced_mmio * KVM_COALESCED_MMIO_MAX),
+    ]
+
+
 class kvm_guest_debug_arch_x86(Structure):
     _fields_ = [
         ('debugreg',        c_uint64 * 8),
@@ -300,3 +434,104 @@ class kvm_guest_debug(Structure):
         ('pad',             c_uint32),
         ('arch',            kvm_guest_debug_arch),
     ]
+
+
+class kvm_irq_level(Structure):
+    _fields_ = [
+        ('irq',             c_uint32),  # union with status (s32)
+        ('level',           c_uint32),
+    ]
+
+class kvm_pit_config(Structure):
+    _fields_ = [
+        ('flags',           c_uint32),
+        ('pad',             c_uint32 * 15),
+    ]
+
+    KVM_PIT_SPEAKER_DUMMY = 1
+
+class kvm_irq_routing_irqchip(Structure):
+    _fields_ = [
+        ('irqchip',         c_uint32),
+        ('pin',             c_uint32),
+    ]
+
+class kvm_irq_routing_msi(Structure):
+    _fields_ = [
+        ('address_lo',      c_uint32),
+        ('address_hi',      c_uint32),
+        ('data',            c_uint32),
+        ('devid',           c_uint32),  # union with pad
+    ]
+
+class kvm_irq_routing_entry_union(Union):
+    _fields_ = [
+        ('irqchip',         kvm_irq_routing_irqchip),
+        ('msi',             kvm_irq_routing_msi),
+        ('pad',             c_uint32 * 8),
+    ]
+
+class kvm_irq_routing_entry(Structure):
+    _fields_ = [
+        ('gsi',             c_uint32),
+        ('type',            c_uint32),
+        ('flags',           c_uint32),
+        ('pad',             c_uint32),
+        ('u',               kvm_irq_routing_entry_union),
+    ]
+
+    KVM_IRQ_ROUTING_IRQCHIP = 1
+    KVM_IRQ_ROUTING_MSI     = 2
+
+    # irqchip.irqchip
+    KVM_IRQCHIP_PIC_MASTER  = 0
+    KVM_IRQCHIP_PIC_SLAVE   = 1
+    KVM_IRQCHIP_IOAPIC      = 2
+
+    def __str__(self):
+        if self.type == self.KVM_IRQ_ROUTING_IRQCHIP:
+            return 'GSI {} -> irqchip {} pin {}'.format(
+                    self.gsi, self.u.irqchip.irqchip, self.u.irqchip.pin)
+        if self.type == self.KVM_IRQ_ROUTING_MSI:
+            m = self.u.msi
+            return 'GSI {} -> MSI 0x{:X} data 0x{:X}'.format(
+                    self.gsi, m.address_hi << 32 | m.address_lo, m.data)
+        return 'GSI {} -> type {}'.format(self.gsi, self.type)
+
+def kvm_irq_routing(n):
+    """Return the kvm_irq_routing structure type with room for n entries."""
+    return type('kvm_irq_routing', (Structure,), {'_fields_': [
+        ('nr',              c_uint32),
+        ('flags',           c_uint32),
+        ('entries',         kvm_irq_routing_entry * n),
+    ]})
+
+class kvm_interrupt(Structure):
+    _fields_ = [
+        ('irq',             c_uint32),
+    ]
+
+class kvm_ioeventfd(Structure):
+    _fields_ = [
+        ('datamatch',       c_uint64),
+        ('addr',            c_uint64),
+        ('len',             c_uint32),
+        ('fd',              c_int32),
+        ('flags',           c_uint32),
+        ('pad',             c_uint8 * 36),
+    ]
+
+    KVM_IOEVENTFD_FLAG_DATAMATCH = (1<<0)
+    KVM_IOEVENTFD_FLAG_PIO       = (1<<1)
+    KVM_IOEVENTFD_FLAG_DEASSIGN  = (1<<2)
+
+class kvm_irqfd(Structure):
+    _fields_ = [
+        ('fd',              c_uint32),
+        ('gsi',             c_uint32),
+        ('flags',           c_uint32),
+        ('resamplefd',      c_uint32),
+        ('pad',             c_uint8 * 16),
+    ]
+
+    KVM_IRQFD_FLAG_DEASSIGN = (1<<0)
@@ -0,0 +1,189 @@
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+#
+# Guest RAM allocation: hugepages, NUMA placement and prefaulting.
+
+import os
+import errno
+import mmap
+import ctypes
+
+from errors import KvmError
+
+MAP_HUGETLB = 0x40000
+
+MADV_HUGEPAGE = 14
+MADV_POPULATE_WRITE = 23
+
+MPOL_BIND = 2
+SYS_mbind = 237         # x86_64
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.madvise.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int)
+_libc.syscall.restype = ctypes.c_long
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int,
+        ctypes.c_int, ctypes.c_long)
+_libc.munmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+def _huge_page_size():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('Hugepagesize:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return 2 << 20
+
+HUGE_PAGE_SIZE = _huge_page_size()
+
+
+def _madvise(addr, size, advice):
+    if _libc.madvise(addr, size, advice) == 0:
+        return 0
+    return ctypes.get_errno()
+
+def _mbind(addr, size, node):
+    nlongs = node // 64 + 1
+    mask = (ctypes.c_ulong * nlongs)()
+    mask[node // 64] = 1 << (node % 64)
+    r = _libc.syscall(ctypes.c_long(SYS_mbind), ctypes.c_void_p(addr), ctypes.c_ulong(size),
+            ctypes.c_int(MPOL_BIND), mask, ctypes.c_ulong(nlongs * 64 + 1), ctypes.c_uint(0))
+    if r == 0:
+        return 0
+    return ctypes.get_errno()
+
+
+def alloc_guest_ram(size, hugetlb=True, thp=True, numa_node=None, prefault=False):
+    """Allocate anonymous guest RAM for Vm.add_mem_region().
+
+    Backing is tried in order: pages from the hugetlbfs pool (hugetlb),
+    transparent hugepages on a HUGE_PAGE_SIZE-aligned mapping (thp), then
+    plain pages; the returned buffer's `backing` attribute says which
+    ('hugetlb', 'thp' or 'small'). With numa_node, the memory is bound to
+    that node (KvmError if the node is invalid; ignored on kernels without
+    NUMA). With prefault, every page is faulted in now rather than on the
+    guest's first touch.
+
+    Returns a writable ctypes char array of size bytes, which keeps its
+    mapping alive.
+    """
+    if size <= 0 or size % mmap.PAGESIZE:
+        raise KvmError('Guest RAM size must be a positive multiple of the page size')
+    rw = mmap.PROT_READ | mmap.PROT_WRITE
+    huge = HUGE_PAGE_SIZE
+    m = None
+
+    if hugetlb:
+        try:
+            # Fails right away (ENOMEM) if the pool can't cover it.
+            m = mmap.mmap(-1, (size + huge - 1) & ~(huge - 1),
+                    mmap.MAP_PRIVATE | MAP_HUGETLB, rw)
+            offset = 0
+            backing = 'hugetlb'
+        except EnvironmentError:
+            m = None
+
+    if m is None:
+        # Over-allocate so the buffer can start on a hugepage boundary;
+        # only touched pages use memory.
+        m = mmap.mmap(-1, size + huge, mmap.MAP_PRIVATE, rw)
+        base = ctypes.addressof(ctypes.c_char.from_buffer(m))
+        offset = -base % huge
+        backing = 'small'
+        if thp and _madvise(base + offset, size, MADV_HUGEPAGE) == 0:
+            backing = 'thp'
+
+    ram = (ctypes.c_char * size).from_buffer(m, offset)
+    addr = ctypes.addressof(ram)
+    ram.backing = backing
+    ram.numa_node = None
+
+    if numa_node is not None:
+        err = _mbind(addr, size, numa_node)
+        if err == 0:
+            ram.numa_node = numa_node
+        elif err != errno.ENOSYS:
+            raise KvmError('Cannot bind guest RAM to NUMA node {}: {}'.format(
+                numa_node, os.strerror(err)))
+
+    if prefault:
+        if _madvise(addr, size, MADV_POPULATE_WRITE) != 0:
+            # Kernels before 5.14: touch the memory instead.
+            ctypes.memset(addr, 0, size)
+
+    return ram
+
+
+class _Mapping(object):
+    # Unmaps a libc mmap() when the buffer holding it is freed, or when
+    # every holder (the VM that mapped it, templates and clones sharing it)
+    # has called close().
+    def __init__(self, addr, size):
+        self.addr = addr
+        self.size = size
+        self.refs = 1
+
+    def hold(self):
+        self.refs += 1
+        return self
+
+    def close(self):
+        if self.addr is None:
+            return
+        self.refs -= 1
+        if self.refs == 0:
+            self._unmap()
+
+    def _unmap(self):
+        _libc.munmap(self.addr, self.size)
+        self.addr = None
+
+    def __del__(self):
+        if self.addr is not None:
+            self._unmap()
+
+
+def map_file(f, size=None, offset=0, shared=False):
+    """Map a file (name or file object) for Vm.add_mem_region() without reading it.
+
+    Pages are read in from the page cache when first touched. The mapping
+    is private copy-on-write unless shared, in which case writes go to
+    the file, which must then be writable. size defaults to the rest of
+    the file after offset (which must be page aligned), and is rounded up
+    to the page size; the part of the last page past the end of the file
+    reads as zeros.
+
+    Returns a ctypes char array that unmaps the file when freed.
+    """
+    if isinstance(f, basestring):
+        fd = os.open(f, os.O_RDWR if shared else os.O_RDONLY)
+        try:
+            return map_file(fd, size, offset, shared)
+        finally:
+            os.close(fd)
+    fd = f if isinstance(f, (int, long)) else f.fileno()
+
+    if offset % mmap.PAGESIZE:
+        raise KvmError('File offset must be page aligned')
+    avail = os.fstat(fd).st_size - offset
+    if size is None:
+        size = avail
+    if size <= 0 or size > avail:
+        raise KvmError('Cannot map {} bytes at offset {} of a {} byte file'.format(
+            size, offset, avail + offset))
+    size = (size + mmap.PAGESIZE - 1) & ~(mmap.PAGESIZE - 1)
+
+    flags = mmap.MAP_SHARED if shared else mmap.MAP_PRIVATE
+    addr = _libc.mmap(None, size, mmap.PROT_READ | mmap.PROT_WRITE, flags, fd, offset)
+    if addr in (None, MAP_FAILED):
+        e = ctypes.get_errno()
+        raise KvmError('Cannot map file: {}'.format(os.strerror(e)))
+
+    buf = (ctypes.c_char * size).from_address(addr)
+    buf._mapping = _Mapping(addr, size)
+    return buf
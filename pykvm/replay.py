@@ -0,0 +1,75 @@
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+#
+# Record and replay of the values injected into the guest by I/O and MMIO
+# reads, which is where device non-determinism enters a guest.
+
+import struct
+import ctypes
+
+from exitreason import KvmExit
+from errors import KvmError
+
+# reason, number of data bytes, port or MMIO address; then the data.
+_entry = struct.Struct('<BHQ')
+
+def _read_span(exit):
+    # (address, host address of data, number of bytes) of a read exit.
+    if exit.code == KvmExit.KVM_EXIT_IO:
+        return exit.port, exit.data_addr, exit.size * exit.count
+    return exit.phys_addr, exit.data_addr, exit.len
+
+
+class InputRecorder(object):
+    """Logs the data every I/O or MMIO read returned to the guest.
+
+    Attach with Vcpu.record_inputs(). The data is captured just before the
+    vcpu re-enters the guest, whichever device or handler supplied it.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def record(self, exit):
+        addr, data_addr, n = _read_span(exit)
+        self.f.write(_entry.pack(exit.code, n, addr))
+        self.f.write(ctypes.string_at(data_addr, n))
+        self.count += 1
+
+    def close(self):
+        self.f.close()
+
+
+class InputReplayer(object):
+    """Feeds logged read data back to the guest in place of devices.
+
+    Attach with Vcpu.replay_inputs(). Raises KvmError if the guest's reads
+    diverge from the log or run past its end.
+    """
+
+    def __init__(self, f):
+        self._data = f.read()
+        self._off = 0
+        self.count = 0
+
+    def __len__(self):
+        return len(self._data) - self._off
+
+    def replay(self, exit):
+        addr, data_addr, n = _read_span(exit)
+        off = self._off
+        end = off + _entry.size
+        if end > len(self._data):
+            raise KvmError('Input log exhausted after {} reads'.format(self.count))
+        code, size, log_addr = _entry.unpack_from(self._data, off)
+        if code != exit.code or size != n or log_addr != addr:
+            raise KvmError('Replay diverged at read #{}: guest read {} bytes at 0x{:X}, '
+                    'log has {} bytes at 0x{:X}'.format(self.count, n, addr, size, log_addr))
+        if end + n > len(self._data):
+            raise KvmError('Input log truncated at read #{}'.format(self.count))
+        off = end
+        ctypes.memmove(data_addr, self._data[off:off+n], n)
+        self._off = off + n
+        self.count += 1
@@ -0,0 +1,128 @@
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+
+from array import array
+import time
+
+from exitreason import KvmExit, exit_reason_names
+
+# Nanosecond clock: perf_counter_ns() where the interpreter has it.
+now_ns = getattr(time, 'perf_counter_ns', None) or \
+        (lambda: int(time.time() * 1000000000))
+
+NBUCKETS = 64           # bucket b counts latencies in [2**(b-1), 2**b) ns
+NREASONS = 64
+
+# Each histogram has one more slot after the buckets, counting exits
+# recorded without a latency (vcpu timing off).
+UNTIMED = NBUCKETS
+_HIST_LEN = NBUCKETS + 1
+
+def _new_hist():
+    return array('L', [0]) * _HIST_LEN
+
+def _summary(hist):
+    return {'count': sum(hist), 'hist': hist[:NBUCKETS].tolist()}
+
+
+class ExitStats(object):
+    """Per-vcpu exit counters and log2-bucketed latency histograms.
+
+    Latency is the time spent in KVM_RUN for each exit; exits recorded
+    with ns=None are counted but stay out of the histograms. Histograms are
+    kept by exit reason (one preallocated flat array), by I/O port and by
+    MMIO region (one array per key, allocated when the key is first seen).
+    MMIO exits outside any MmioBus region are keyed by their page.
+    """
+
+    def __init__(self, mmio_bus):
+        self._mmio_bus = mmio_bus
+        self.reset()
+
+    def reset(self):
+        self.reasons = array('L', [0]) * (NREASONS * _HIST_LEN)
+        self.ports = {}
+        self.mmio = {}
+
+    def record(self, exit, ns):
+        if ns is None:
+            b = UNTIMED
+        else:
+            b = ns.bit_length()
+            if b >= NBUCKETS:
+                b = NBUCKETS - 1
+        code = exit.code
+        self.reasons[min(code, NREASONS - 1) * _HIST_LEN + b] += 1
+
+        if code == KvmExit.KVM_EXIT_IO:
+            h = self.ports.get(exit.port)
+            if h is None:
+                h = self.ports[exit.port] = _new_hist()
+            h[b] += 1
+        elif code == KvmExit.KVM_EXIT_MMIO:
+            addr = exit.phys_addr
+            key = self._mmio_bus.region_base(addr)
+            if key is None:
+                key = addr & ~0xFFF
+            h = self.mmio.get(key)
+            if h is None:
+                h = self.mmio[key] = _new_hist()
+            h[b] += 1
+
+    def snapshot(self):
+        """Return the counters as plain dicts and lists.
+
+        {'reasons': {name: {'count': n, 'hist': [...]}}, 'ports': {port: ...},
+         'mmio': {region base: ...}}
+        """
+        reasons = {}
+        for code in xrange(NREASONS):
+            hist = self.reasons[code * _HIST_LEN:(code + 1) * _HIST_LEN]
+            if any(hist):
+                name = exit_reason_names.get(code, 'KVM_EXIT_{}'.format(code))
+                reasons[name] = _summary(hist)
+        return {
+            'reasons':  reasons,
+            'ports':    dict((k, _summary(h)) for k, h in self.ports.iteritems()),
+            'mmio':     dict((k, _summary(h)) for k, h in self.mmio.iteritems()),
+        }
+
+
+def merge_snapshots(snapshots):
+    """Sum several ExitStats.snapshot() results."""
+    r = {'reasons': {}, 'ports': {}, 'mmio': {}}
+    for snap in snapshots:
+        for group, entries in snap.iteritems():
+            dst = r[group]
+            for key, s in entries.iteritems():
+                d = dst.get(key)
+                if d is None:
+                    dst[key] = {'count': s['count'], 'hist': list(s['hist'])}
+                    continue
+                d['count'] += s['count']
+                d['hist'] = [a + b for a, b in zip(d['hist'], s['hist'])]
+    return r
+
+
+class VmStats(object):
+    """Aggregate view of the ExitStats of all vcpus of a Vm."""
+
+    def __init__(self, vm):
+        self._vm = vm
+
+    def enable(self, enable=True):
+        """Vcpu.enable_stats() on every vcpu, including ones added later."""
+        vm = self._vm
+        vm._record_stats = enable
+        if enable:
+            vm.timing = True
+        for v in vm.vcpus.itervalues():
+            v.enable_stats(enable)
+
+    def snapshot(self):
+        return merge_snapshots(v.stats.snapshot() for v in self._vm.vcpus.itervalues())
+
+    def reset(self):
+        for v in self._vm.vcpus.itervalues():
+            v.stats.reset()
@@ -0,0 +1,155 @@
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+#
+# Single-step instruction tracer. Register snapshots go into a preallocated
+# ctypes array of kvm_regs and are exported as one array per register.
+
+from array import array
+import ctypes
+
+from kvmstructs import *
+from exitreason import KvmExit
+from breakpoint import DR6_BS
+from trace import deinterleave
+
+# kvm_regs field names, in layout order.
+REGS = tuple(name for name, ctype in kvm_regs._fields_)
+
+_REGS_SIZE = ctypes.sizeof(kvm_regs)
+
+
+class StepTrace(object):
+    """The register state after each traced instruction.
+
+    Holds the most recent `capacity` steps in a preallocated buffer of
+    kvm_regs. Use column()/columns() to get one array('L') per register
+    (64 bits on LP64 hosts), oldest step first; the arrays support the
+    buffer protocol, e.g. for numpy.frombuffer(col, numpy.uint64).
+    """
+
+    def __init__(self, capacity=1<<16):
+        self.capacity = capacity
+        self._rows = (kvm_regs * capacity)()
+        self._n = 0
+        self._wrapped = False
+
+    def __len__(self):
+        return self.capacity if self._wrapped else self._n
+
+    def clear(self):
+        self._n = 0
+        self._wrapped = False
+
+    def __getitem__(self, i):
+        """Return a copy of the registers after step i (oldest first)."""
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('step index out of range')
+        if self._wrapped:
+            i = (self._n + i) % self.capacity
+        return kvm_regs.from_buffer_copy(self._rows[i])
+
+    def _bytes(self):
+        # All held rows, oldest first.
+        end = self._n * _REGS_SIZE
+        buf = buffer(self._rows)
+        if self._wrapped:
+            return bytearray(buf[end:]) + bytearray(buf[:end])
+        return bytearray(buf[:end])
+
+    def column(self, name):
+        """Return one register across all held steps as an array('L')."""
+        return self.columns((name,))[name]
+
+    def columns(self, names=REGS):
+        """Return a {register name: array('L')} dict, oldest step first."""
+        rows = self._bytes()
+        r = {}
+        for name in names:
+            off = getattr(kvm_regs, name).offset
+            r[name] = array('L', deinterleave(rows, _REGS_SIZE, off, 8))
+        return r
+
+
+class StepTracer(object):
+    """Single-steps a vcpu, recording the registers after every instruction.
+
+    Each step goes through the same entry and exit work as Vcpu.run()
+    (interrupt injection, coalesced MMIO, input record/replay, stats and
+    tracing), and exits that run() would handle, such as I/O and MMIO
+    dispatched to the VM's device buses, are handled the same way; any
+    other exit, including a breakpoint hit, stops the trace and is
+    returned. Registers come from kvm_run when sync regs are enabled (no
+    extra ioctl per step), otherwise from one KVM_GET_REGS per step.
+    """
+
+    def __init__(self, vcpu, capacity=1<<16):
+        self.vcpu = vcpu
+        self.trace = StepTrace(capacity)
+        # Single-step exits aren't returned, so they needn't be copied.
+        self._views = KvmExit.views_for(vcpu)
+
+    def step(self, n):
+        """Trace up to n instructions.
+
+        Returns None after n steps, or the exit that stopped the trace.
+        """
+        return self._step(n, None, None)
+
+    def run_until(self, start, end=None, limit=None):
+        """Trace until RIP lands in [start, end) (just start if end is None).
+
+        Gives up after limit steps, if set. Returns None once RIP is in the
+        range or the limit is reached, or the exit that stopped the trace.
+        """
+        if end is None:
+            end = start + 1
+        return self._step(limit, start, end)
+
+    def _step(self, n, lo, hi):
+        vcpu = self.vcpu
+        views = vcpu._exit_views or self._views
+        trace = self.trace
+        rows = trace._rows
+        capacity = trace.capacity
+        ioctl = vcpu._ioctl
+        fd = vcpu.fd
+        sync = vcpu._sync_regs & kvm_sync_regs.KVM_SYNC_X86_REGS
+        sync_addr = ctypes.addressof(vcpu._sync.regs)
+        memmove = ctypes.memmove
+        addressof = ctypes.addressof
+        DEBUG = KvmExit.KVM_EXIT_DEBUG
+
+        vcpu.enable_single_step()
+        try:
+            steps = 0
+            while n is None or steps < n:
+                r = vcpu._run_once(views)
+                if r.code != DEBUG or not r.dr6 & DR6_BS:
+                    if vcpu._handle_exit(r):
+                        continue
+                    if views is self._views:
+                        r = KvmExit.from_vcpu(vcpu, r.dt)
+                    return r
+
+                i = trace._n
+                row = rows[i]
+                if sync:
+                    memmove(addressof(row), sync_addr, _REGS_SIZE)
+                else:
+                    ioctl(fd, vcpu.KVM_GET_REGS, row)
+                i += 1
+                if i == capacity:
+                    i = 0
+                    trace._wrapped = True
+                trace._n = i
+                steps += 1
+
+                if lo is not None and lo <= row.rip < hi:
+                    break
+        finally:
+            vcpu.disable_single_step()
+        return None
@@ -0,0 +1,182 @@
+# pykvm
+# https://github.com/JonathonReinhart/pykvm
+# (C) 2015 Jonathon Reinhart
+#
+# Binary exit trace: fixed-width records, written in large chunks, read back
+# into one array per field.
+
+from array import array
+from collections import Counter
+from itertools import compress, imap, repeat
+import operator
+import struct
+
+from kvmstructs import *
+from exitreason import KvmExit, exit_reason_names
+
+MAGIC = 'PYKVMTR1'
+
+# ts_ns, addr (port or MMIO address), data, rip,
+# reason, size, flags, cpuid, count
+_record = struct.Struct('<QQQQHBBHH')
+RECORD_SIZE = _record.size
+
+FLAG_WRITE = (1<<0)
+FLAG_RIP   = (1<<1)
+
+_header = struct.Struct('<8sII')
+
+# (name, offset, width, array typecode); 'L' is 64 bits on LP64 hosts.
+FIELDS = (
+    ('ts',      0,  8, 'L'),
+    ('addr',    8,  8, 'L'),
+    ('data',    16, 8, 'L'),
+    ('rip',     24, 8, 'L'),
+    ('reason',  32, 2, 'H'),
+    ('size',    34, 1, 'B'),
+    ('flags',   35, 1, 'B'),
+    ('cpuid',   36, 2, 'H'),
+    ('count',   38, 2, 'H'),
+)
+
+
+def deinterleave(records, record_size, offset, width):
+    """Return the width-byte field at offset of each fixed-size record, as one string.
+
+    records must hold a whole number of records.
+    """
+    # Strided slices, so the work per record happens in C.
+    n = len(records) // record_size
+    col = bytearray(n * width)
+    for i in xrange(width):
+        col[i::width] = records[offset+i::record_size]
+    return str(col)
+
+
+class TraceRecorder(object):
+    """Records exits into a preallocated buffer of fixed-width records.
+
+    With a file, the buffer is written out in one sequential write whenever
+    it fills up, and on flush()/close(). Without one, it is a ring holding
+    the most recent `capacity` exits; see write_to().
+
+    Not thread-safe: use one recorder per vcpu (records carry the cpuid).
+    """
+
+    def __init__(self, f=None, capacity=1<<16):
+        self.f = f
+        self.capacity = capacity
+        self._buf = bytearray(capacity * RECORD_SIZE)
+        self._n = 0
+        self._wrapped = False
+        if f is not None:
+            f.write(_header.pack(MAGIC, RECORD_SIZE, 0))
+
+    def record(self, cpuid, exit, ts, rip=None):
+        i = self._n
+        if i == self.capacity:
+            if self.f is not None:
+                self.flush()
+            else:
+                self._wrapped = True
+            i = 0
+
+        code = exit.code
+        addr = data = size = flags = count = 0
+        if code == KvmExit.KVM_EXIT_IO:
+            addr = exit.port
+            size = exit.size
+            count = exit.count
+            if exit.is_write:
+                flags = FLAG_WRITE
+                data = uint_types[size].from_address(exit.data_addr).value
+        elif code == KvmExit.KVM_EXIT_MMIO:
+            addr = exit.phys_addr
+            size = exit.len
+            if exit.is_write:
+                flags = FLAG_WRITE
+                data = c_uint64.from_address(exit.data_addr).value & ((1 << (size * 8)) - 1)
+        if rip is not None:
+            flags |= FLAG_RIP
+        else:
+            rip = 0
+
+        _record.pack_into(self._buf, i * RECORD_SIZE,
+                ts, addr, data, rip, code, size, flags, cpuid, count)
+        self._n = i + 1
+
+    def flush(self):
+        if self.f is not None and self._n:
+            self.f.write(buffer(self._buf, 0, self._n * RECORD_SIZE))
+            self._n = 0
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+
+    def write_to(self, f):
+        """Write the records held by a file-less recorder, oldest first."""
+        f.write(_header.pack(MAGIC, RECORD_SIZE, 0))
+        end = self._n * RECORD_SIZE
+        if self._wrapped:
+            f.write(buffer(self._buf, end))
+        f.write(buffer(self._buf, 0, end))
+
+
+class Trace(object):
+    """A trace loaded as one array per record field (see FIELDS)."""
+
+    def __init__(self):
+        for name, off, width, typecode in FIELDS:
+            setattr(self, name, array(typecode))
+
+    def __len__(self):
+        return len(self.ts)
+
+    def _extend(self, chunk):
+        for name, off, width, typecode in FIELDS:
+            getattr(self, name).fromstring(deinterleave(chunk, RECORD_SIZE, off, width))
+
+    def summary(self, top=10):
+        """Return a dict of record count, duration, exit rate and top keys."""
+        n = len(self)
+        if not n:
+            return {'records': 0}
+        duration = (self.ts[-1] - self.ts[0]) * 1e-9
+        reasons = Counter(self.reason)
+        io = KvmExit.KVM_EXIT_IO
+        mmio = KvmExit.KVM_EXIT_MMIO
+        # Filter the addr column by reason with iterators that run in C,
+        # rather than building a tuple per record.
+        eq = operator.eq
+        ports = Counter(compress(self.addr, imap(eq, self.reason, repeat(io))))
+        pages = Counter(imap(operator.and_,
+                compress(self.addr, imap(eq, self.reason, repeat(mmio))), repeat(~0xFFF)))
+        return {
+            'records':      n,
+            'duration':     duration,
+            'exits_per_sec': n / duration if duration else None,
+            'reasons':      dict((exit_reason_names.get(k, k), v) for k, v in reasons.iteritems()),
+            'top_ports':    ports.most_common(top),
+            'top_mmio_pages': pages.most_common(top),
+        }
+
+
+def read_trace(f, chunk_records=1<<16):
+    """Load a trace written by TraceRecorder from a file object or name."""
+    if isinstance(f, basestring):
+        with open(f, 'rb') as fobj:
+            return read_trace(fobj, chunk_records)
+
+    magic, record_size, reserved = _header.unpack(f.read(_header.size))
+    if magic != MAGIC or record_size != RECORD_SIZE:
+        raise ValueError('Not a pykvm trace file')
+
+    t = Trace()
+    while True:
+        chunk = f.read(chunk_records * RECORD_SIZE)
+        if not chunk:
+            break
+        t._extend(chunk[:len(chunk) - len(chunk) % RECORD_SIZE])
+    return t
@@ -6,8 +6,6 @@
 
 import sys
 import os, os.path
-import mmap
-import struct
 
 import pykvm
 from pykvm.exitreason import *
@@ -41,36 +39,29 @@ def test_sregs(vcpu):
     print sregs
 
 
-def map_file_to_guest(vm, filename, guest_phys_addr, size, readonly):
-    # Unfortunately, ctypes doesn't support readonly memmaps, so we can't
-    # really get the address of the memmap.
+def map_firmware(vm, filename):
+    size = os.path.getsize(filename)
+    base = 0xFFFFFFFF - size + 1
+    assert(size & 0xFFF == 0)
+    print 'Mapping {0} kB firmware @ 0x{1:X}'.format(size/1024, base)
+    vm.add_file_region(base, filename)
 
-    with open(filename, 'rb') as f:
-        data = f.read()
-    assert(len(data) == size)
-    return map_to_guest(vm, guest_phys_addr, data, readonly)
 
-def map_to_guest(vm, guest_phys_addr, data, readonly):
-    # TODO: What alignment?
-    m = mmap.mmap(-1, len(data))
-    m[:] = data
-    vm.add_mem_region(guest_phys_addr, m, readonly)
 
-def map_firmware(vm, filename):
-    with open(filename, 'rb') as f:
-        fw = f.read()
-    base = 0xFFFFFFFF - len(fw) + 1
-    assert(len(fw) & 0xFFF == 0)
-    print 'Mapping {0} kB firmware @ 0x{1:X}'.format(len(fw)/1024, base)
-    map_to_guest(vm, base, fw, True)
+class DeadBeefDevice(pykvm.Device):
+    def io_read(self, port, size):
+        return 0xDEADBEEF & ((1 << (size * 8)) - 1)
 
+    def io_write(self, port, size, value):
+        print 'Write to port 0x{:X}: 0x{:X}'.format(port, value)
 
 
 def handle_io(vcpu, exit):
+    # Ports not claimed by a device on vm.io_bus end up here.
     if exit.is_write:
         pass
     else:
-        exit.set_data(struct.pack('<I', 0xDEADBEEF))
+        exit.set_data('\xFF' * exit.size)
     return True
 
 def handle_int_err(vcpu, exit):
@@ -120,12 +111,13 @@ def main():
     #test_sregs(vcpu)
 
     # 1 MB RAM
-    m = mmap.mmap(-1, 1<<20)
-    vm.add_mem_region(0, m)
+    vm.add_mem_region(0, pykvm.alloc_guest_ram(1<<20))
 
 
     map_firmware(vm, firmware_filename)
 
+    vm.io_bus.register(0xDEAD, 1, DeadBeefDevice())
+
 
     # Causes failure
     #test_enable_single_step(vcpu)